@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import vosk
+from model_registry import ModelRegistry
+from recognizer_pool import RecognizerPool
+
+logger = logging.getLogger(__name__)
+
+WORKER_MODE = os.environ.get('ASR_WORKER_MODE', 'thread')  # 'thread' or 'process'
+WORKER_COUNT = int(os.environ.get('ASR_WORKERS', 0)) or os.cpu_count() or 1
+PRELOAD_LANGUAGES = [language for language in os.environ.get('ASR_PRELOAD', 'en').split(',') if language]
+MODEL_MEMORY_MB = int(os.environ.get('ASR_MODEL_MEMORY_MB', 0))  # 0 = never evict
+POOL_MIN = int(os.environ.get('ASR_POOL_MIN', 2))  # Idle recognizers kept ready per language and worker process
+POOL_MAX = int(os.environ.get('ASR_POOL_MAX', 8))
+
+# Worker-side state. In thread mode all worker threads share it (models are
+# read-only and each recognizer is only touched by the worker it is pinned to);
+# in process mode every worker process holds its own copy, forked from the parent.
+_registry = None
+_pool = None
+_recognizers = {}
+_pool_keys = {}
+
+
+def _init_registry(model_paths, preload, memory_budget_mb, pool_min, pool_max):
+    global _registry, _pool
+    _registry = ModelRegistry(model_paths, memory_budget_mb)
+    _registry.preload(preload)
+    _pool = RecognizerPool(_registry, pool_min, pool_max, refill_languages=preload)
+    _registry.reclaim = _pool.drop_idle
+
+
+def _model_report():
+    return _registry.report()
+
+
+def _pool_report():
+    return _pool.report()
+
+
+def _open_recognizer(key, language, sample_rate, config):
+    _recognizers[key] = _pool.acquire(language, sample_rate, config)
+    _pool_keys[key] = (language, sample_rate, config)
+
+
+def _warm_recognizers(language, sample_rate, config):
+    _pool.warm(language, sample_rate, config)
+
+
+def _waveform(pcm_data):
+    # KaldiRecognizer passes its argument to C as char*, which cffi only accepts
+    # as bytes; ring-buffer views are wrapped in place instead of copied.
+    if isinstance(pcm_data, bytes):
+        return pcm_data
+    return vosk._ffi.from_buffer(pcm_data)
+
+
+def _accept_waveform(key, pcm_data, want_partial=True):
+    # Returns (text, is_final, seconds spent in Vosk), timed on the worker so
+    # queueing behind other streams isn't counted as decode time
+    recognizer = _recognizers.get(key)
+    if recognizer is None:
+        return "", False, 0.0
+    started = time.perf_counter()
+    if recognizer.AcceptWaveform(_waveform(pcm_data)):
+        return json.loads(recognizer.Result()).get("text", ""), True, time.perf_counter() - started
+    if not want_partial:
+        return "", False, time.perf_counter() - started
+    return json.loads(recognizer.PartialResult()).get("partial", ""), False, time.perf_counter() - started
+
+
+def _finalize_recognizer(key):
+    recognizer = _recognizers.get(key)
+    if recognizer is None:
+        return ""
+    return json.loads(recognizer.FinalResult()).get("text", "")
+
+
+def _close_recognizer(key, pcm_data):
+    recognizer = _recognizers.pop(key, None)
+    if recognizer is None:
+        return ""
+    pool_key = _pool_keys.pop(key)
+    try:
+        if pcm_data and recognizer.AcceptWaveform(pcm_data):
+            text = json.loads(recognizer.Result()).get("text", "")
+        else:
+            text = json.loads(recognizer.FinalResult()).get("text", "")  # Force final result
+    except Exception:
+        _pool.discard(pool_key[0])
+        raise
+    _pool.release(*pool_key, recognizer)
+    return text
+
+
+class RecognitionWorkerPool:
+    def __init__(self, model_paths, mode=WORKER_MODE, workers=WORKER_COUNT,
+                 preload=PRELOAD_LANGUAGES, memory_budget_mb=MODEL_MEMORY_MB, pool_min=POOL_MIN, pool_max=POOL_MAX):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"Unknown ASR worker mode: {mode}. Supported: thread, process")
+        self.mode = mode
+        self.size = max(1, workers)
+        # Preloaded models are loaded here, before any worker exists, so forked
+        # worker processes share their pages copy-on-write instead of each
+        # loading a private copy. Other languages load lazily inside the worker.
+        _init_registry(model_paths, preload, memory_budget_mb, pool_min, pool_max)
+        self.preload = preload
+        # One single-threaded executor per worker: a pinned session's calls run
+        # in submission order, and at most `size` decodes run at once.
+        if mode == 'process':
+            context = multiprocessing.get_context('fork')
+            self.executors = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(self.size)]
+        else:
+            self.executors = [
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'vosk-worker-{i}')
+                for i in range(self.size)
+            ]
+        self.assignments = {}
+        self.load = [0] * self.size
+        logger.info(f"Recognition worker pool started: {self.size} {mode} workers")
+
+    def pin(self, key):
+        if key not in self.assignments:
+            worker = min(range(self.size), key=self.load.__getitem__)
+            self.assignments[key] = worker
+            self.load[worker] += 1
+        return self.assignments[key]
+
+    def release(self, key):
+        worker = self.assignments.pop(key, None)
+        if worker is not None:
+            self.load[worker] -= 1
+
+    def submit(self, key, fn, *args):
+        def log_failure(future):
+            if not future.cancelled() and future.exception():
+                logger.error(f"Recognition worker task {fn.__name__} failed for {key}: {future.exception()}")
+
+        future = self.executors[self.assignments[key]].submit(fn, *args)
+        future.add_done_callback(log_failure)
+        return future
+
+    async def run(self, key, fn, *args):
+        executor = self.executors[self.assignments[key]]
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def model_stats(self):
+        # Per-worker view of loaded models: load time, resident size, sessions
+        if self.mode == 'thread':
+            return [_model_report()]
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(executor, _model_report) for executor in self.executors))
+
+    def warm(self, sample_rate, config):
+        # Fills the recognizer pools of preloaded languages in the background;
+        # thread-mode workers share one pool, process-mode workers each have their own
+        executors = self.executors if self.mode == 'process' else self.executors[:1]
+        for executor in executors:
+            for language in self.preload:
+                executor.submit(_warm_recognizers, language, sample_rate, config)
+
+    async def pool_stats(self):
+        # Per-worker recognizer pool hits, misses, discards and idle counts
+        if self.mode == 'thread':
+            return [_pool_report()]
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(executor, _pool_report) for executor in self.executors))
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,150 @@
+import math
+
+import numpy as np
+
+# Sample formats a client may declare at register, as NumPy dtypes
+S16LE = 's16le'
+F32LE = 'f32le'
+FORMATS = {S16LE: np.dtype('<i2'), F32LE: np.dtype('<f4')}
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 192000
+
+
+def validate_format(sample_rate, format=S16LE):
+    # A client's declared audio as the (sample_rate, format) key an ingest stage is built for
+    if format not in FORMATS:
+        raise ValueError(f"Unknown sample format: {format}. Supported: {', '.join(FORMATS)}")
+    if not isinstance(sample_rate, int) or not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f"Unsupported sample rate: {sample_rate}. Supported: {MIN_SAMPLE_RATE}-{MAX_SAMPLE_RATE} Hz")
+    return (sample_rate, format)
+
+
+def lowpass_taps(cutoff, taps):
+    # Blackman-windowed sinc with unity DC gain; cutoff in cycles per input sample
+    n = np.arange(taps) - (taps - 1) / 2
+    h = np.sinc(2 * cutoff * n) * np.blackman(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+class AudioIngest:
+    # Turns one client's mono PCM, at whatever rate and sample format it
+    # declared, into the 16-bit PCM at target_rate the recognizer expects.
+    # A batch of frames goes through a few whole-array steps: decode to
+    # float32, anti-alias lowpass (when downsampling), resample by linear
+    # interpolation at fractional positions, gain, clip and cast to int16.
+    # State carried between batches: the filter's input history, the
+    # resampler's position and the gain, so output does not depend on how
+    # the audio was split into frames.
+    def __init__(self, sample_rate, format=S16LE, target_rate=16000, normalize=True, target_dbfs=-20.0,
+                 max_gain=8.0, min_speech_dbfs=-50.0, release_seconds=2.0, taps_per_ratio=32):
+        self.spec = validate_format(sample_rate, format)
+        self.sample_rate = sample_rate
+        self.dtype = FORMATS[format]
+        self.target_rate = target_rate
+        self.step = sample_rate / target_rate  # Input samples per output sample
+        self.remainder = b''  # Trailing bytes of an incomplete sample
+        if sample_rate > target_rate:
+            # Cut off a little below the output Nyquist frequency; the filter
+            # grows with the ratio so the transition band stays the same width
+            taps = int(self.step * taps_per_ratio) | 1
+            self.taps = lowpass_taps(0.45 / self.step, taps)
+            lead = 0
+            if self.step.is_integer():
+                # Polyphase form for whole-number ratios (48 kHz and 32 kHz):
+                # phase p of the filter only ever meets every step-th sample.
+                # The filter is zero-padded at the front to a whole number of
+                # phases, which reads `lead` more samples of history.
+                self.factor = int(self.step)
+                phased = np.zeros(-(-taps // self.factor) * self.factor, dtype=np.float32)
+                lead = len(phased) - taps
+                phased[lead:] = self.taps
+                self.phases = phased.reshape(-1, self.factor).T.copy()
+            else:
+                self.phases = None
+            self.history = np.zeros(lead + taps, dtype=np.float32)  # Input ending with the previous batch's last sample
+        else:
+            self.taps = None
+        self.last = np.float32(0.0)  # Last sample of the previous batch
+        self.position = 1.0  # Of the next output sample, in input samples from self.last
+
+        # Gain normalization: pulls speech towards target_dbfs RMS, never above
+        # max_gain nor past full scale. Gain drops at once on loud input and
+        # rises over about release_seconds; quieter batches (silence, line
+        # noise) leave it alone so they are not boosted.
+        self.normalize = normalize
+        self.target_rms = 10 ** (target_dbfs / 20)
+        self.max_gain = max_gain
+        self.min_speech_rms = 10 ** (min_speech_dbfs / 20)
+        self.release_seconds = release_seconds
+        self.gain = 2.0 if normalize else 1.0  # The fixed boost browsers used to apply
+
+    def decode(self, data):
+        if self.remainder:
+            data = self.remainder + data
+        size = self.dtype.itemsize
+        end = len(data) - len(data) % size
+        self.remainder = bytes(data[end:])
+        samples = np.frombuffer(data, dtype=self.dtype, count=end // size)
+        if self.dtype.kind == 'i':
+            return samples.astype(np.float32) * np.float32(1 / 32768)
+        return samples.astype(np.float32, copy=False)
+
+    def resample(self, samples):
+        if self.sample_rate == self.target_rate:
+            return samples
+        # Output positions index into [last, samples...]; each needs the sample
+        # on either side, so the final one stays for the next batch
+        span = len(samples)
+        count = max(0, math.ceil((span - self.position) / self.step))
+        positions = self.position + self.step * np.arange(count)
+        index = positions.astype(np.intp)
+        fraction = (positions - index).astype(np.float32)
+        if self.taps is not None:
+            # Filter output j is the lowpassed [last, samples...][j]
+            padded = np.concatenate((self.history, samples))
+            self.history = padded[span:]
+            if self.phases is not None:
+                # Positions are whole samples: a strided correlation per phase
+                output = np.zeros(count, dtype=np.float32)
+                if count:
+                    start = index[0]
+                    for phase, taps in enumerate(self.phases):
+                        strided = padded[start + phase::self.factor]
+                        output += np.correlate(strided[:count + len(taps) - 1], taps, mode='valid')
+            else:
+                filtered = np.convolve(padded, self.taps, mode='valid')
+                output = filtered[index] + fraction * (filtered[index + 1] - filtered[index])
+        else:
+            signal = np.concatenate(((self.last,), samples))
+            output = signal[index] + fraction * (signal[index + 1] - signal[index])
+        self.position += count * self.step - span
+        if span:
+            self.last = samples[-1]
+        return output
+
+    def apply_gain(self, samples):
+        gain = self.gain
+        if self.normalize and len(samples):
+            rms = float(np.sqrt(np.dot(samples, samples) / len(samples)))
+            if rms >= self.min_speech_rms:
+                peak = float(np.abs(samples).max())
+                wanted = min(self.target_rms / rms, self.max_gain, 0.99 / peak)
+                if wanted < gain:
+                    gain = wanted
+                else:
+                    release = 1.0 - math.exp(-len(samples) / self.target_rate / self.release_seconds)
+                    gain += (wanted - gain) * release
+        if gain > self.gain:
+            # Ramp up across the batch instead of stepping
+            samples = samples * np.linspace(self.gain, gain, len(samples), dtype=np.float32)
+        else:
+            samples = samples * np.float32(gain)
+        self.gain = gain
+        return samples
+
+    def process(self, frames):
+        # One batch: the frames a stream received since it was last serviced
+        samples = self.resample(self.decode(b''.join(frames)))
+        samples = self.apply_gain(samples)
+        np.clip(samples, -1.0, 32767 / 32768, out=samples)
+        return (samples * 32768).astype('<i2').tobytes()
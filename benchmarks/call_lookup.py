@@ -0,0 +1,41 @@
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from call_index import CallIndex
+
+# Per-frame cost of resolving a participant's call (and peer) with the old
+# linear scan over `calls` versus the shared CallIndex, as active calls grow.
+
+LOOKUPS = 2000
+
+
+def build(active_calls):
+    calls, index = {}, CallIndex()
+    for i in range(active_calls):
+        call_id, caller, callee = f'call_{i}', f'sales_{i}', f'customer_{i}'
+        calls[call_id] = {'caller': caller, 'callee': callee}
+        index.add(call_id, caller, callee)
+    return calls, index
+
+
+def scan_lookup(calls, username):
+    call_id = next((cid for cid, call in calls.items() if username in (call['caller'], call['callee'])), None)
+    if call_id:
+        return calls[call_id]['callee'] if username == calls[call_id]['caller'] else calls[call_id]['caller']
+
+
+def main():
+    print(f"{'calls':>7} {'scan ns/frame':>14} {'index ns/frame':>15}")
+    for active_calls in (10, 100, 1000, 5000, 10000):
+        calls, index = build(active_calls)
+        users = [f'customer_{random.randrange(active_calls)}' for _ in range(LOOKUPS)]
+        scan = timeit.timeit(lambda: [scan_lookup(calls, u) for u in users], number=1) / LOOKUPS
+        indexed = min(timeit.repeat(lambda: [index.peer_of(u) for u in users], number=1, repeat=5)) / LOOKUPS
+        print(f"{active_calls:>7} {scan * 1e9:>14.0f} {indexed * 1e9:>15.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audio_ingest import AudioIngest, F32LE, S16LE
+
+# Throughput of the transcription server's ingest stage per core: CPU time
+# to convert a minute of client audio to 16 kHz int16, for common browser
+# rates and formats, with frames converted one at a time or in batches as
+# the server does when a stream has frames queued. "Streams/core" is how
+# many real-time streams one core could keep up with on ingest alone.
+
+FRAME_MS = 20
+
+
+def make_audio(sample_rate, format, seconds):
+    # Speech-like test signal: a few harmonics with a syllable-rate envelope, plus noise
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    voice = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((180, 360, 720, 2400)))
+    signal = 0.05 * voice * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)) + 0.002 * np.random.randn(len(t))
+    if format == S16LE:
+        return (signal * 32767).astype('<i2').tobytes()
+    return signal.astype('<f4').tobytes()
+
+
+def measure(sample_rate, format, batch_frames, seconds):
+    audio = make_audio(sample_rate, format, seconds)
+    frame_bytes = sample_rate * FRAME_MS // 1000 * (2 if format == S16LE else 4)
+    frames = [audio[i:i + frame_bytes] for i in range(0, len(audio), frame_bytes)]
+    batches = [frames[i:i + batch_frames] for i in range(0, len(frames), batch_frames)]
+    best = None
+    for _ in range(3):
+        ingest = AudioIngest(sample_rate, format)
+        started = time.process_time()
+        for batch in batches:
+            ingest.process(batch)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(frames), seconds / best  # Audio seconds per CPU second = real-time streams per core
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest stage (resample, normalize, int16) throughput per core")
+    parser.add_argument('--seconds', type=float, default=60, help="audio per measurement")
+    args = parser.parse_args()
+    print(f"{'input':>14} {'batch':>6} {'us/frame':>9} {'streams/core':>13}")
+    for sample_rate in (16000, 44100, 48000):
+        for format in (S16LE, F32LE):
+            for batch_frames in (1, 5, 10):
+                per_frame, speed = measure(sample_rate, format, batch_frames, args.seconds)
+                print(f"{sample_rate:>7} {format:>6} {batch_frames:>6} {per_frame * 1e6:>9.1f} {speed:>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import websockets
+
+# Starts the signaling, relay and transcription servers on their usual ports
+# (8080/8001, 8002, 8003) with a throwaway self-signed certificate and drives
+# N concurrent calls through them the way the browser does: register on all
+# three sockets, call_user -> accept_call, then 20 ms relay and PCM frames from
+# both parties for --duration seconds, then hang_up. Everything runs on
+# localhost and needs no network.
+#
+# Transcription uses the real Vosk backend when vosk is importable and
+# vosk-model/ holds the English model, otherwise benchmarks/stub_asr. Each PCM
+# frame carries a marker with its frame number; the stub echoes the newest
+# marker as its transcript, so transcript latency is exact (send of the frame
+# to receipt of the update). With real Vosk only counts are reported.
+#
+# Speech is synthetic: SPEECH_MS of tone, then PAUSE_MS of silence, so the
+# VAD skips pauses and forces finals like it would on a real conversation.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_ASR = os.path.join(REPO, 'benchmarks', 'stub_asr')
+MODEL_DIR = os.path.join(REPO, 'vosk-model')
+SERVERS = {
+    'signaling': ('http_signaling_server.py', 8001),
+    'relay': ('udp_relay_server.py', 8002),
+    'transcribe': ('transcribe_server.py', 8003),
+}
+FRAME_MS = 20
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+MARKER = 0x7A5A
+SPEECH_MS = 2000
+PAUSE_MS = 1000
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class Results:
+    def __init__(self):
+        self.setup = []  # call_user -> call_accepted, seconds
+        self.relay = array('d')  # relay frame one-way latency, seconds
+        self.relay_sent = 0
+        self.relay_received = 0
+        self.pcm_sent = 0
+        self.partials = array('d')
+        self.finals = array('d')
+        self.transcripts = 0
+        self.send_lag = array('d')  # how late the harness sent frames vs. schedule
+        self.failed_calls = 0
+
+    def merge(self, other):
+        self.setup += other.setup
+        for name in ('relay', 'partials', 'finals', 'send_lag'):
+            getattr(self, name).extend(getattr(other, name))
+        for name in ('relay_sent', 'relay_received', 'pcm_sent', 'transcripts', 'failed_calls'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+def percentile(values, pct):
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def pcm_frame(seq, speaking):
+    # Speech frames are a 300 Hz tone with the marker in the first three
+    # samples; pause frames are near-silent and unmarked
+    if not speaking:
+        return bytes(FRAME_SAMPLES * 2)
+    t = (np.arange(FRAME_SAMPLES) + seq * FRAME_SAMPLES) / SAMPLE_RATE
+    samples = (np.sin(2 * np.pi * 300 * t) * 6000).astype('<i2').view('<u2')
+    samples[:3] = (MARKER, seq & 0xFFFF, seq >> 16)
+    return samples.tobytes()
+
+
+def make_certificate(directory):
+    if not shutil.which('openssl'):
+        sys.exit("openssl is needed to create the self-signed certificate")
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', os.path.join(directory, 'key.pem'),
+                    '-out', os.path.join(directory, 'cert.pem')], check=True, capture_output=True)
+
+
+def vosk_available():
+    return (importlib.util.find_spec('vosk') is not None
+            and os.path.isdir(os.path.join(MODEL_DIR, 'vosk-model-en-us-0.22')))
+
+
+class ProcessTree:
+    # CPU seconds and resident memory of a server and its worker processes, from /proc
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+
+    def pids(self):
+        pids, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            try:
+                for task in os.listdir(f'/proc/{pid}/task'):
+                    with open(f'/proc/{pid}/task/{task}/children') as children:
+                        stack.extend(int(child) for child in children.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def sample(self):
+        cpu = rss = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/stat') as stat:
+                    fields = stat.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+                with open(f'/proc/{pid}/statm') as statm:
+                    rss += int(statm.read().split()[1]) * PAGE_SIZE
+            except (OSError, IndexError, ValueError):
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+        return cpu
+
+
+async def wait_for_port(port, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.2)
+    return False
+
+
+async def start_servers(workdir, asr, startup_timeout):
+    processes = {}
+    for name in ('relay', 'transcribe', 'signaling'):  # Signaling connects to the other two at startup
+        script, port = SERVERS[name]
+        env = dict(os.environ)
+        if name == 'transcribe' and asr == 'stub':
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [STUB_ASR, env.get('PYTHONPATH')]))
+        with socket.socket() as probe:
+            if probe.connect_ex(('127.0.0.1', port)) == 0:
+                sys.exit(f"Port {port} is already in use; stop the running {name} server first")
+        log = open(os.path.join(workdir, f'{name}.log'), 'w')
+        processes[name] = subprocess.Popen([sys.executable, os.path.join(REPO, script)],
+                                           cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if not await wait_for_port(port, processes[name], startup_timeout):
+            stop_servers(processes)
+            sys.exit(f"{name} server did not start; see {log.name}")
+    await asyncio.sleep(0.5)  # Let signaling finish connecting to the relay and transcription server
+    return processes
+
+
+def stop_servers(processes):
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class Participant:
+    def __init__(self, group, username, ssl_context, results):
+        self.group = group
+        self.username = username
+        self.ssl = ssl_context
+        self.results = results
+        self.events = asyncio.Queue()
+        self.sent_at = []  # frame number -> send time
+        self.readers = []
+
+    async def connect(self):
+        self.signaling = await websockets.connect('wss://localhost:8001', ssl=self.ssl, ping_interval=None)
+        self.relay = await websockets.connect('wss://localhost:8002', ssl=self.ssl, ping_interval=None)
+        self.transcribe = await websockets.connect('wss://localhost:8003', ssl=self.ssl, ping_interval=None)
+        self.readers = [asyncio.create_task(self.read_signaling()),
+                        asyncio.create_task(self.read_relay())]
+        await self.relay.send(json.dumps({'event': 'register', 'group': self.group, 'username': self.username}))
+        await self.transcribe.send(json.dumps({'event': 'register', 'group': self.group, 'username': self.username,
+                                               'language': 'en', 'pcm_frame_ms': FRAME_MS}))
+        await self.transcribe.recv()  # 'registered'
+        self.readers.append(asyncio.create_task(self.read_transcripts()))
+        await self.signaling.send(json.dumps({'event': 'register', 'group': self.group, 'username': self.username}))
+        await self.wait_for('set_cookie')
+
+    async def read_signaling(self):
+        async for message in self.signaling:
+            event = json.loads(message).get('event')
+            if event not in ('user_status', 'user_status_delta'):
+                self.events.put_nowait(event)
+
+    async def wait_for(self, event, timeout=30):
+        while True:
+            received = await asyncio.wait_for(self.events.get(), timeout)
+            if received == event:
+                return
+            if received == 'error':
+                raise RuntimeError(f"{self.username} got an error waiting for {event}")
+
+    async def read_relay(self):
+        async for message in self.relay:
+            if isinstance(message, bytes):
+                self.results.relay.append(time.perf_counter() - struct.unpack_from('!d', message)[0])
+                self.results.relay_received += 1
+
+    async def read_transcripts(self):
+        async for message in self.transcribe:
+            data = json.loads(message)
+            for item in data.get('items', [data]):
+                if item.get('event') != 'transcription':
+                    continue
+                self.results.transcripts += 1
+                speaker = self.peer if item['group'] != self.group else self
+                text = item['text']
+                if text.startswith('frame'):
+                    seq = int(text[5:])
+                    if seq < len(speaker.sent_at):
+                        latency = time.perf_counter() - speaker.sent_at[seq]
+                        (self.results.finals if item['is_final'] else self.results.partials).append(latency)
+
+    async def stream(self, duration, relay_bytes):
+        padding = bytes(max(0, relay_bytes - 8))
+        frames = int(duration * 1000 / FRAME_MS)
+        period = (SPEECH_MS + PAUSE_MS) // FRAME_MS
+        silence = pcm_frame(0, False)
+        started = time.perf_counter()
+        for seq in range(frames):
+            target = started + seq * FRAME_MS / 1000
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.perf_counter()
+            self.results.send_lag.append(now - target)
+            speaking = seq % period < SPEECH_MS // FRAME_MS
+            frame = pcm_frame(seq, True) if speaking else silence
+            self.sent_at.append(now)
+            await self.relay.send(struct.pack('!d', now) + padding)
+            await self.transcribe.send(frame)
+            self.results.relay_sent += 1
+            self.results.pcm_sent += 1
+
+    async def close(self):
+        for ws in (self.signaling, self.relay, self.transcribe):
+            await ws.close()
+        await asyncio.gather(*self.readers, return_exceptions=True)
+
+
+async def run_call(i, args, ssl_context, results, delay):
+    await asyncio.sleep(delay)
+    caller = Participant('sales', f'load_sales_{i}', ssl_context, results)
+    callee = Participant('customers', f'load_customer_{i}', ssl_context, results)
+    caller.peer, callee.peer = callee, caller
+    call_id = f'load_call_{i}'
+    try:
+        await asyncio.gather(caller.connect(), callee.connect())
+        started = time.perf_counter()
+        await caller.signaling.send(json.dumps({'event': 'call_user', 'call_id': call_id, 'to_user': callee.username,
+                                                'from_group': 'sales', 'from_user': caller.username}))
+        await callee.wait_for('incoming_call')
+        await callee.signaling.send(json.dumps({'event': 'accept_call', 'call_id': call_id, 'language': 'en'}))
+        await caller.wait_for('call_accepted')
+        results.setup.append(time.perf_counter() - started)
+        await asyncio.gather(caller.stream(args.duration, args.relay_bytes),
+                             callee.stream(args.duration, args.relay_bytes))
+        await caller.signaling.send(json.dumps({'event': 'hang_up', 'call_id': call_id}))
+        await asyncio.gather(caller.wait_for('call_ended'), callee.wait_for('call_ended'))
+        await asyncio.sleep(1)  # Let the last transcripts arrive
+    except Exception as e:
+        results.failed_calls += 1
+        print(f"call {i} failed: {e!r}", file=sys.stderr)
+    finally:
+        for participant in (caller, callee):
+            if participant.readers:
+                await participant.close()
+
+
+async def run_calls(indices, args):
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    results = Results()
+    await asyncio.gather(*(run_call(i, args, ssl_context, results, args.ramp * i / args.calls) for i in indices))
+    return results
+
+
+def drive_calls(indices, args):
+    return asyncio.run(run_calls(indices, args))
+
+
+def summarize(args, asr, results, elapsed, cpu, trees, harness_cpu):
+    ms = lambda values, pct: round(percentile(values, pct) * 1000, 2)
+    report = {
+        'calls': args.calls,
+        'failed_calls': results.failed_calls,
+        'duration': args.duration,
+        'asr': asr,
+        'elapsed_s': round(elapsed, 2),
+        'setup_ms': {'p50': ms(results.setup, 50), 'p99': ms(results.setup, 99)},
+        'relay': {
+            'frames_per_s': round(results.relay_received / elapsed, 1),
+            'delivered': round(results.relay_received / results.relay_sent, 4) if results.relay_sent else 0,
+            'p50_ms': ms(results.relay, 50),
+            'p99_ms': ms(results.relay, 99),
+        },
+        'pcm_frames_per_s': round(results.pcm_sent / elapsed, 1),
+        'transcripts_per_s': round(results.transcripts / elapsed, 1),
+        'partial_ms': {'count': len(results.partials), 'p50': ms(results.partials, 50), 'p99': ms(results.partials, 99)},
+        'final_ms': {'count': len(results.finals), 'p50': ms(results.finals, 50), 'p99': ms(results.finals, 99)},
+        'servers': {name: {'cpu_cores': round(cpu[name] / elapsed, 3), 'peak_rss_mib': round(tree.peak_rss / 2**20, 1)}
+                    for name, tree in trees.items()},
+        'harness': {'cpu_cores': round(harness_cpu / elapsed, 3), 'send_lag_p99_ms': ms(results.send_lag, 99)},
+    }
+    print(f"{args.calls} calls ({results.failed_calls} failed), {args.duration:.0f}s of audio each, "
+          f"{asr} ASR, {elapsed:.1f}s wall")
+    print(f"  call setup     p50 {report['setup_ms']['p50']:>8} ms   p99 {report['setup_ms']['p99']:>8} ms")
+    print(f"  relay          p50 {report['relay']['p50_ms']:>8} ms   p99 {report['relay']['p99_ms']:>8} ms   "
+          f"{report['relay']['frames_per_s']:.0f} frames/s, {report['relay']['delivered']:.2%} delivered")
+    print(f"  partials       p50 {report['partial_ms']['p50']:>8} ms   p99 {report['partial_ms']['p99']:>8} ms   "
+          f"{report['partial_ms']['count']} updates")
+    print(f"  finals         p50 {report['final_ms']['p50']:>8} ms   p99 {report['final_ms']['p99']:>8} ms   "
+          f"{report['final_ms']['count']} updates (includes the VAD's end-of-speech wait)")
+    print(f"  throughput     {report['pcm_frames_per_s']:.0f} PCM frames/s in, {report['transcripts_per_s']:.1f} transcripts/s out")
+    for name, server in report['servers'].items():
+        print(f"  {name:<14} {server['cpu_cores']:.2f} cores, {server['peak_rss_mib']:.0f} MiB peak RSS")
+    print(f"  harness        {report['harness']['cpu_cores']:.2f} cores, send lag p99 "
+          f"{report['harness']['send_lag_p99_ms']} ms (if this approaches {FRAME_MS} ms the client is the bottleneck)")
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Concurrent-call load test for the signaling, relay and transcription servers")
+    parser.add_argument('--calls', type=int, default=50, help="concurrent calls (two participants each)")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds of audio per call")
+    parser.add_argument('--ramp', type=float, default=5.0, help="seconds over which call starts are spread")
+    parser.add_argument('--relay-bytes', type=int, default=120, help="size of each 20 ms relay frame (WebM Opus is ~100)")
+    parser.add_argument('--processes', type=int, default=1, help="client processes to spread the calls over, "
+                        "for when one process can't keep up (see the harness send lag)")
+    parser.add_argument('--asr', choices=('auto', 'stub', 'vosk'), default='auto')
+    parser.add_argument('--startup-timeout', type=float, default=120.0, help="seconds to wait for each server, model loading included")
+    parser.add_argument('--json', help="also write the results to this file, for comparing releases")
+    parser.add_argument('--keep-logs', action='store_true', help="keep the server logs and print where they are")
+    args = parser.parse_args()
+
+    asr = args.asr
+    if asr == 'auto':
+        asr = 'vosk' if vosk_available() else 'stub'
+    elif asr == 'vosk' and not vosk_available():
+        sys.exit(f"Real Vosk needs the vosk package and {MODEL_DIR}/vosk-model-en-us-0.22")
+
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    make_certificate(workdir)
+    for name in ('index.html', 'static'):  # The signaling server serves these from its working directory
+        os.symlink(os.path.join(REPO, name), os.path.join(workdir, name))
+    if asr == 'vosk':
+        os.symlink(MODEL_DIR, os.path.join(workdir, 'vosk-model'))
+    processes = await start_servers(workdir, asr, args.startup_timeout)
+    trees = {name: ProcessTree(process.pid) for name, process in processes.items()}
+
+    async def sample_memory():
+        while True:
+            for tree in trees.values():
+                tree.sample()
+            await asyncio.sleep(0.5)
+
+    try:
+        cpu_start = {name: tree.sample() for name, tree in trees.items()}
+        harness_start = time.process_time()
+        started = time.perf_counter()
+        sampler = asyncio.create_task(sample_memory())
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        results = Results()
+        if args.processes > 1:
+            # Calls are dealt round-robin so every process ramps up at the same pace
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context('fork')) as executor:
+                for part in await asyncio.gather(*(loop.run_in_executor(executor, drive_calls, range(n, args.calls, args.processes), args)
+                                                   for n in range(args.processes))):
+                    results.merge(part)
+        else:
+            results = await run_calls(range(args.calls), args)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        cpu = {name: tree.sample() - cpu_start[name] for name, tree in trees.items()}
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        harness_cpu = (time.process_time() - harness_start + children.ru_utime + children.ru_stime
+                       - children_start.ru_utime - children_start.ru_stime)
+        report = summarize(args, asr, results, elapsed, cpu, trees, harness_cpu)
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump(report, out, indent=2)
+    finally:
+        stop_servers(processes)
+        if args.keep_logs:
+            print(f"Server logs in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
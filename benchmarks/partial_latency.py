@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vosk_asr import VoskASR
+
+# Streams a 16 kHz mono WAV through VoskASR in real time, 20 ms per frame like
+# the browser worklet, and reports how stale each transcript update is when it
+# comes out: emit time minus capture time of the start of the audio chunk that
+# produced it. Run from the repo root so the vosk-model/ paths resolve.
+
+FRAME_MS = 20
+BYTES_PER_SECOND = 16000 * 2
+
+
+def load_pcm(path):
+    with wave.open(path, 'rb') as wav:
+        if wav.getframerate() != 16000 or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            sys.exit(f"{path} must be 16 kHz mono 16-bit PCM")
+        return wav.readframes(wav.getnframes())
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def measure(asr, pcm, language):
+    call_id, group = f'bench_{asr.stream_mode}', 'sales'
+    asr.start_session(call_id, group, language)
+    chunk_bytes = asr.sessions[(call_id, group)]['chunk_bytes']
+    frame_bytes = BYTES_PER_SECOND * FRAME_MS // 1000
+    latencies = []
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    for offset in range(0, len(pcm), frame_bytes):
+        # Pace frames so that byte offsets map to capture wall-clock time
+        await asyncio.sleep(max(0.0, start + offset / BYTES_PER_SECOND - time.monotonic()))
+        frame = pcm[offset:offset + frame_bytes]
+        transcript, is_final = await asr.process_audio(call_id, group, frame)
+        if transcript:
+            decoded = offset + len(frame) - asr.backlog(call_id, group)['bytes']
+            chunk_start = start + (decoded - chunk_bytes) / BYTES_PER_SECOND
+            latencies.append(time.monotonic() - chunk_start)
+    await asr.end_session(call_id, group)
+    cpu = time.process_time() - cpu_start
+    return latencies, cpu
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Partial transcript latency, streaming vs batch mode")
+    parser.add_argument('wav', help="16 kHz mono 16-bit speech recording")
+    parser.add_argument('--language', default='en')
+    args = parser.parse_args()
+
+    pcm = load_pcm(args.wav)
+    audio_seconds = len(pcm) / BYTES_PER_SECOND
+    print(f"{'mode':<10} {'updates':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'cpu/audio s':>12}")
+    for stream_mode in ('batch', 'streaming'):
+        asr = VoskASR(mode='thread', workers=1, stream_mode=stream_mode)
+        latencies, cpu = await measure(asr, pcm, args.language)
+        asr.workers.shutdown()
+        if not latencies:
+            print(f"{stream_mode:<10} no transcript updates")
+            continue
+        print(f"{stream_mode:<10} {len(latencies):>8} "
+              f"{statistics.median(latencies) * 1000:>8.0f} {percentile(latencies, 95) * 1000:>8.0f} "
+              f"{max(latencies) * 1000:>8.0f} {cpu / audio_seconds:>12.3f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
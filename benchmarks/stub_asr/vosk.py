@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+import numpy as np
+
+# Stand-in for the vosk package, put first on the transcription server's
+# PYTHONPATH by load_test.py when no model is installed. It decodes nothing:
+# it sleeps audio_seconds * STUB_ASR_RTF per call (releasing the GIL like the
+# real decoder) and reports the sequence number of the newest load_test frame
+# marker it has seen as its text, so the client can tell exactly which frame
+# each transcript update reflects.
+
+MARKER = 0x7A5A  # First sample of a marked frame; the next two carry the frame number
+RTF = float(os.environ.get('STUB_ASR_RTF', 0.05))
+FINAL_MS = int(os.environ.get('STUB_ASR_FINAL_MS', 2000))  # Decoded audio per utterance
+
+
+class _FFI:
+    @staticmethod
+    def from_buffer(data):
+        return data
+
+
+_ffi = _FFI()
+
+
+def SetLogLevel(level):
+    pass
+
+
+class Model:
+    def __init__(self, path):
+        self.path = path
+
+
+class KaldiRecognizer:
+    def __init__(self, model, sample_rate, config=None):
+        self.sample_rate = sample_rate
+        self.Reset()
+
+    def Reset(self):
+        self.decoded = 0
+        self.frame = None
+
+    def AcceptWaveform(self, data):
+        samples = np.frombuffer(data, dtype='<u2')
+        time.sleep(len(samples) / self.sample_rate * RTF)
+        marks = np.flatnonzero(samples[:-2] == MARKER)
+        if marks.size:
+            i = int(marks[-1])
+            self.frame = int(samples[i + 1]) | int(samples[i + 2]) << 16
+        self.decoded += len(samples)
+        if self.decoded >= self.sample_rate * FINAL_MS // 1000:
+            self.decoded = 0
+            return 1
+        return 0
+
+    def _text(self):
+        return f'frame{self.frame}' if self.frame is not None else ''
+
+    def Result(self):
+        text, self.frame = self._text(), None
+        return json.dumps({'text': text})
+
+    def PartialResult(self):
+        return json.dumps({'partial': self._text()})
+
+    def FinalResult(self):
+        self.decoded = 0
+        return self.Result()
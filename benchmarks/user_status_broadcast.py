@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import websockets
+import http_signaling_server as signaling
+
+# Delivers a burst of roster changes to N connected clients: the old way (one
+# full roster per change, awaited client by client), coalesced full rosters
+# fanned out with websockets.broadcast, and coalesced deltas. Clients run in
+# this process over plain ws:// on localhost, so the times include their
+# receive work as well. 'deliver ms' for the coalesced runs includes the
+# USER_STATUS_WINDOW wait. The old way moves O(N^2) bytes per change, so it is
+# skipped above --max-sequential clients.
+
+received = 0
+delivered = asyncio.Event()
+expected = 0
+
+
+async def sequential_broadcast():
+    status = signaling.user_status()
+    for ws in signaling.registry.clients():
+        await ws.send(status)
+
+
+async def serve_client(websocket, counter=itertools.count()):
+    username = f'customer_{next(counter)}'
+    connection = signaling.registry.connect(websocket, '127.0.0.1')
+    signaling.registry.register(connection, 'customers', username)
+    await websocket.wait_closed()
+    signaling.registry.disconnect(connection)
+
+
+async def read_updates(websocket):
+    global received
+    async for _ in websocket:
+        received += 1
+        if received == expected:
+            delivered.set()
+
+
+async def deliver(burst, mode):
+    global received, expected
+    received = 0
+    delivered.clear()
+    clients = len(signaling.registry)
+    started = time.perf_counter()
+    signaling.USER_STATUS_DELTAS = mode == 'deltas'
+    if mode == 'sequential':
+        expected = clients * burst
+        for i in range(burst):
+            signaling.users['sales'][f'sales_{mode}_{i}'] = None  # Roster entry only, nothing to deliver to
+            await sequential_broadcast()
+    else:
+        expected = clients
+        for i in range(burst):
+            signaling.users['sales'][f'sales_{mode}_{i}'] = None  # Roster entry only, nothing to deliver to
+            signaling.schedule_user_status('sales', f'sales_{mode}_{i}', True)
+    sent = time.perf_counter()
+    await delivered.wait()
+    done = time.perf_counter()
+    return expected, sent - started, done - started
+
+
+async def run(clients, burst, max_sequential):
+    signaling.users['sales'].clear()
+    signaling.users['customers'].clear()
+    async with websockets.serve(serve_client, '127.0.0.1', 0, ping_interval=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        connections = []
+        for start in range(0, clients, 500):
+            connections += await asyncio.gather(*(websockets.connect(f'ws://127.0.0.1:{port}', ping_interval=None)
+                                                  for _ in range(start, min(clients, start + 500))))
+        readers = [asyncio.create_task(read_updates(ws)) for ws in connections]
+        while len(signaling.registry) < clients:
+            await asyncio.sleep(0.01)
+        for mode in ('sequential', 'coalesced', 'deltas'):
+            if mode == 'sequential' and clients > max_sequential:
+                print(f"{clients:>7} {burst:>6} {mode:<11} {'skipped':>9}")
+                continue
+            messages, send_time, total_time = await deliver(burst, mode)
+            print(f"{clients:>7} {burst:>6} {mode:<11} {messages:>9} {send_time * 1000:>10.1f} {total_time * 1000:>10.1f}")
+        for ws in connections:
+            await ws.close()
+        await asyncio.gather(*readers)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="user_status fan-out to many simulated clients")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--burst', type=int, default=20, help="roster changes per burst")
+    parser.add_argument('--max-sequential', type=int, default=1000, help="largest client count to run the old way")
+    args = parser.parse_args()
+    print(f"{'clients':>7} {'burst':>6} {'mode':<11} {'messages':>9} {'enqueue ms':>10} {'deliver ms':>10}")
+    for clients in args.clients:
+        await run(clients, args.burst, args.max_sequential)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+import asyncio
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+CATCH_UP = 'catch-up'  # On overflow discard everything queued and resume from live audio
+POLICIES = (DROP_OLDEST, DROP_NEWEST, CATCH_UP)
+
+
+class BoundedQueue(asyncio.Queue):
+    # Fixed-size queue whose producers never wait: offer() applies the overflow
+    # policy instead, so a slow consumer only ever hurts its own stream.
+    def __init__(self, maxsize, policy=DROP_OLDEST, drop_counter=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}. Supported: {', '.join(POLICIES)}")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = 0
+        self.drop_counter = drop_counter  # Optional shared metrics.Counter, counts drops across queues
+
+    def offer(self, item):
+        if self.full():
+            if self.policy == DROP_NEWEST:
+                self._count_drop()
+                return False
+            if self.policy == DROP_OLDEST:
+                self._discard()
+            else:
+                self.clear()
+        self.put_nowait(item)
+        return True
+
+    def clear(self):
+        discarded = 0
+        while not self.empty():
+            self._discard()
+            discarded += 1
+        return discarded
+
+    def close(self, sentinel=None):
+        # Queued items are abandoned (not counted as drops) so the consumer
+        # sees the sentinel next
+        while not self.empty():
+            self.get_nowait()
+            self.task_done()
+        self.put_nowait(sentinel)
+
+    def _discard(self):
+        self.get_nowait()
+        self.task_done()
+        self._count_drop()
+
+    def _count_drop(self):
+        self.dropped += 1
+        if self.drop_counter:
+            self.drop_counter.inc()
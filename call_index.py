@@ -0,0 +1,41 @@
+class CallIndex:
+    # Bidirectional participant <-> call index shared by the relay and the
+    # transcription server, so per-frame lookups are dict hits instead of a scan
+    # over every active call. Maintained from call_accepted / call_ended.
+    def __init__(self):
+        self.calls = {}  # call_id -> (caller, callee)
+        self.by_user = {}  # username -> call_id
+        self.peers = {}  # username -> the other participant
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __contains__(self, call_id):
+        return call_id in self.calls
+
+    def add(self, call_id, caller, callee):
+        self.remove(call_id)
+        self.calls[call_id] = (caller, callee)
+        self.by_user[caller] = call_id
+        self.by_user[callee] = call_id
+        self.peers[caller] = callee
+        self.peers[callee] = caller
+
+    def remove(self, call_id):
+        participants = self.calls.pop(call_id, None)
+        if participants:
+            for user in participants:
+                # A participant may already have moved on to a newer call
+                if self.by_user.get(user) == call_id:
+                    del self.by_user[user]
+                    self.peers.pop(user, None)
+        return participants
+
+    def call_of(self, username):
+        return self.by_user.get(username)
+
+    def peer_of(self, username):
+        return self.peers.get(username)
+
+    def participants(self, call_id):
+        return self.calls.get(call_id, ())
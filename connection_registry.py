@@ -0,0 +1,89 @@
+class Connection:
+    __slots__ = ('ws', 'ip', 'group', 'username', 'calls')
+
+    def __init__(self, ws, ip):
+        self.ws = ws
+        self.ip = ip
+        self.group = None
+        self.username = None
+        self.calls = set()  # call_ids this connection takes part in
+
+
+class Call:
+    __slots__ = ('call_id', 'caller', 'callee', 'from_user', 'to_user', 'caller_group', 'callee_group')
+
+    def __init__(self, call_id, caller, callee, from_user, to_user, caller_group, callee_group):
+        self.call_id = call_id
+        self.caller = caller
+        self.callee = callee
+        self.from_user = from_user
+        self.to_user = to_user
+        self.caller_group = caller_group
+        self.callee_group = callee_group
+
+    @property
+    def participants(self):
+        return (self.caller, self.callee)
+
+
+class ConnectionRegistry:
+    # Signaling-side session state: every open websocket has one Connection,
+    # which knows its registered user and the calls it is in, so logout and
+    # disconnect touch only that connection's entries instead of scanning
+    # every user and call.
+    def __init__(self, groups=('sales', 'customers')):
+        self.connections = {}  # websocket -> Connection
+        self.roster = {group: {} for group in groups}  # group -> username -> Connection
+        self.calls = {}  # call_id -> Call
+
+    def __len__(self):
+        return len(self.connections)
+
+    def connect(self, ws, ip):
+        connection = Connection(ws, ip)
+        self.connections[ws] = connection
+        return connection
+
+    def clients(self):
+        return [connection.ws for connection in self.connections.values() if connection.username]
+
+    def register(self, connection, group, username):
+        # Returns the (group, username) this connection gave up, as unregister() does
+        departed = self.unregister(connection)
+        connection.group = group
+        connection.username = username
+        self.roster[group][username] = connection
+        return departed
+
+    def unregister(self, connection):
+        # Returns (group, username) if the connection still held that roster
+        # entry; a newer connection for the same user keeps it otherwise
+        group, username = connection.group, connection.username
+        connection.group = connection.username = None
+        if username and self.roster[group].get(username) is connection:
+            del self.roster[group][username]
+            return group, username
+        return None
+
+    def lookup(self, group, username):
+        return self.roster.get(group, {}).get(username)
+
+    def add_call(self, call):
+        self.remove_call(call.call_id)
+        self.calls[call.call_id] = call
+        for connection in call.participants:
+            connection.calls.add(call.call_id)
+
+    def remove_call(self, call_id):
+        call = self.calls.pop(call_id, None)
+        if call:
+            for connection in call.participants:
+                connection.calls.discard(call_id)
+        return call
+
+    def disconnect(self, connection):
+        # Drops the connection and every call it was in; returns the removed
+        # roster entry (or None) and the removed calls for the caller to announce
+        self.connections.pop(connection.ws, None)
+        calls = [self.remove_call(call_id) for call_id in list(connection.calls)]
+        return self.unregister(connection), calls
@@ -6,27 +6,72 @@ import websockets
 from aiohttp import web
 import os
 from websockets import State
+from transcription_router import TranscriptionRouter
+from connection_registry import Call, ConnectionRegistry
+from metrics import REGISTRY, metrics_handler, monitor_event_loop
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
 
-users = {'sales': {}, 'customers': {}}
-calls = {}
-websocket_clients = {}
-udp_relay_socket = None
-transcribe_socket = None
+registry = ConnectionRegistry()
+users = registry.roster  # group -> username -> Connection
+# Every relay worker gets every call event, on its own control port. With the
+# relay on one host the URLs follow from the same RELAY_WORKERS and
+# RELAY_CONTROL_PORT it was started with; UDP_RELAY_URLS overrides them.
+RELAY_WORKERS = int(os.environ.get('RELAY_WORKERS', 1))
+RELAY_CONTROL_PORT = int(os.environ.get('RELAY_CONTROL_PORT', 8200))
+if 'UDP_RELAY_URLS' in os.environ:
+    UDP_RELAY_URLS = os.environ['UDP_RELAY_URLS'].split(',')
+elif RELAY_WORKERS > 1:
+    UDP_RELAY_URLS = [f'wss://localhost:{RELAY_CONTROL_PORT + worker}' for worker in range(RELAY_WORKERS)]
+else:
+    UDP_RELAY_URLS = ['wss://localhost:8002']
+udp_relay_sockets = dict.fromkeys(UDP_RELAY_URLS)  # url -> socket, None once it failed
+# Transcription is sharded across one or more backends; each call is routed to one
+TRANSCRIBE_BACKENDS = os.environ.get('TRANSCRIBE_BACKENDS', 'wss://localhost:8003').split(',')
+TRANSCRIBE_PLACEMENT = os.environ.get('TRANSCRIBE_PLACEMENT', 'hash')  # 'hash' or 'least-loaded'
+transcription_router = TranscriptionRouter(TRANSCRIBE_BACKENDS, TRANSCRIBE_PLACEMENT)
+MIN_CHUNK_MS = 20  # Accepted per-call chunk_ms; same bounds as vosk_asr's
+MAX_CHUNK_MS = 1000
 
-async def broadcast_user_status():
-    sales = list(users['sales'].keys())
-    customers = list(users['customers'].keys())
-    status = json.dumps({'event': 'user_status', 'sales': sales, 'customers': customers})
+# Roster changes within USER_STATUS_WINDOW are coalesced into one update, which
+# is serialized once and written to every client without awaiting any of them.
+# In delta mode clients get who joined/left instead of the whole roster.
+USER_STATUS_WINDOW = 0.05  # seconds
+USER_STATUS_DELTAS = os.environ.get('USER_STATUS_DELTAS', '0') == '1'
+pending_roster = {}  # (group, username) -> True if online, False if gone
+user_status_timer = None
+
+CALLS_PLACED = REGISTRY.counter('signaling_calls_placed_total', 'call_user requests that reached the callee').labels()
+CALLS_ACCEPTED = REGISTRY.counter('signaling_calls_accepted_total', 'Calls accepted by the callee').labels()
+NOTIFY_FAILURES = REGISTRY.counter('signaling_notify_failures_total', 'Failed notifications to the relay or transcription servers',
+                                   ('service',))
+REGISTRY.gauge('signaling_connections', 'Open signaling websockets', fn=lambda: len(registry))
+REGISTRY.gauge('signaling_users', 'Registered users', fn=lambda: sum(map(len, users.values())))
+REGISTRY.gauge('signaling_active_calls', 'Calls placed and not yet ended', fn=lambda: len(registry.calls))
+
+def user_status():
+    return json.dumps({'event': 'user_status', 'sales': list(users['sales']), 'customers': list(users['customers'])})
+
+def schedule_user_status(group, username, online):
+    global user_status_timer
+    pending_roster[(group, username)] = online
+    if user_status_timer is None:
+        user_status_timer = asyncio.get_running_loop().call_later(USER_STATUS_WINDOW, flush_user_status)
+
+def flush_user_status():
+    global user_status_timer
+    user_status_timer = None
+    if USER_STATUS_DELTAS:
+        joined = {'sales': [], 'customers': []}
+        left = {'sales': [], 'customers': []}
+        for (group, username), online in pending_roster.items():
+            (joined if online else left)[group].append(username)
+        status = json.dumps({'event': 'user_status_delta', 'joined': joined, 'left': left})
+    else:
+        status = user_status()
+    pending_roster.clear()
     logging.debug(f"Broadcasting user status: {status}")
-    for username, ws in list(websocket_clients.items()):
-        if ws.state == State.OPEN:
-            try:
-                await ws.send(status)
-            except Exception as e:
-                logging.error(f"Error broadcasting to {username} ({ws.remote_address[0]}): {e}")
-                del websocket_clients[username]
+    websockets.broadcast(registry.clients(), status)
 
 async def notify_service(socket, service_name, event, data):
     if socket and socket.state == State.OPEN:
@@ -35,23 +80,46 @@ async def notify_service(socket, service_name, event, data):
             logging.debug(f"Notified {service_name}: {event} - {data}")
         except Exception as e:
             logging.error(f"Error notifying {service_name}: {e}")
+            NOTIFY_FAILURES.labels(service_name).inc()
             return False
     else:
         logging.warning(f"{service_name} socket not open or connected")
+        NOTIFY_FAILURES.labels(service_name).inc()
         return False
     return True
 
 async def notify_both_services(event, data):
-    global udp_relay_socket, transcribe_socket
-    udp_success = await notify_service(udp_relay_socket, "UDP relay", event, data)
-    transcribe_success = await notify_service(transcribe_socket, "transcription server", event, data)
-    if not udp_success:
-        udp_relay_socket = None
-    if not transcribe_success:
-        transcribe_socket = None
+    sockets = list(udp_relay_sockets.items())
+    results = await asyncio.gather(*(notify_service(socket, "UDP relay", event, data) for _, socket in sockets))
+    transcription_backend = await transcription_router.notify(event, data)
+    for (url, _), udp_success in zip(sockets, results):
+        if not udp_success:
+            udp_relay_sockets[url] = None
+    return transcription_backend
+
+async def logout(connection):
+    departed = registry.unregister(connection)
+    if departed:
+        schedule_user_status(*departed, False)
+        await notify_both_services('logout', {'ip': connection.ip})
+
+async def disconnect(connection):
+    departed, ended = registry.disconnect(connection)
+    if departed:
+        schedule_user_status(*departed, False)
+        await notify_both_services('logout', {'ip': connection.ip})
+    for call in ended:
+        for participant in call.participants:
+            if participant is not connection and participant.ws.state == State.OPEN:
+                try:
+                    await participant.ws.send(json.dumps({'event': 'call_ended'}))
+                except websockets.ConnectionClosed:
+                    pass  # The peer's own close runs its cleanup
+        await notify_both_services('call_ended', {'call_id': call.call_id})
 
 async def handle_websocket(websocket):
     client_ip = websocket.remote_address[0]
+    connection = registry.connect(websocket, client_ip)
     try:
         async for message in websocket:
             if isinstance(message, str):
@@ -64,10 +132,16 @@ async def handle_websocket(websocket):
                     if not all([group, username]):
                         await websocket.send(json.dumps({'event': 'error', 'message': 'Missing group or username'}))
                         continue
-                    users[group][username] = {'ws': websocket, 'ip': client_ip}
-                    websocket_clients[username] = websocket
+                    if group not in users:
+                        await websocket.send(json.dumps({'event': 'error', 'message': 'Unknown group'}))
+                        continue
+                    departed = registry.register(connection, group, username)
+                    if departed:  # Re-registered under another name; the old one is gone
+                        schedule_user_status(*departed, False)
                     await websocket.send(json.dumps({'event': 'set_cookie', 'session_id': f'{group}_{username}'}))
-                    await broadcast_user_status()
+                    if USER_STATUS_DELTAS:
+                        await websocket.send(user_status())  # Deltas only make sense on top of a snapshot
+                    schedule_user_status(group, username, True)
                 elif event == 'call_user':
                     call_id = data.get('call_id')
                     to_user = data.get('to_user')
@@ -77,18 +151,11 @@ async def handle_websocket(websocket):
                     if not all([call_id, to_user, from_group, from_user]):
                         await websocket.send(json.dumps({'event': 'error', 'message': 'Missing call_id, to_user, from_group, or from_user'}))
                         continue
-                    if to_group in users and to_user in users[to_group]:
-                        calls[call_id] = {
-                            'caller_ws': websocket,
-                            'callee_ws': users[to_group][to_user]['ws'],
-                            'caller_ip': users[from_group][from_user]['ip'],
-                            'callee_ip': users[to_group][to_user]['ip'],
-                            'caller_group': from_group,
-                            'callee_group': to_group,
-                            'from_user': from_user,
-                            'to_user': to_user
-                        }
-                        await users[to_group][to_user]['ws'].send(json.dumps({
+                    callee = registry.lookup(to_group, to_user)
+                    if callee:
+                        registry.add_call(Call(call_id, connection, callee, from_user, to_user, from_group, to_group))
+                        CALLS_PLACED.inc()
+                        await callee.ws.send(json.dumps({
                             'event': 'incoming_call',
                             'call_id': call_id,
                             'from_user': from_user
@@ -100,16 +167,33 @@ async def handle_websocket(websocket):
                     if not call_id:
                         await websocket.send(json.dumps({'event': 'error', 'message': 'Missing call_id'}))
                         continue
-                    if call_id in calls:
-                        await calls[call_id]['caller_ws'].send(json.dumps({'event': 'call_accepted'}))
-                        await notify_both_services('call_accepted', {
+                    chunk_ms = data.get('chunk_ms')  # Optional per-call streaming frame size
+                    if chunk_ms is not None and (type(chunk_ms) is not int or
+                                                 not MIN_CHUNK_MS <= chunk_ms <= MAX_CHUNK_MS):
+                        await websocket.send(json.dumps({'event': 'error', 'message': 'Invalid chunk_ms'}))
+                        continue
+                    call = registry.calls.get(call_id)
+                    if call:
+                        await call.caller.ws.send(json.dumps({'event': 'call_accepted'}))
+                        CALLS_ACCEPTED.inc()
+                        transcription_backend = await notify_both_services('call_accepted', {
                             'call_id': call_id,
-                            'from_user': calls[call_id]['from_user'],
-                            'to_user': calls[call_id]['to_user'],
-                            'caller_group': calls[call_id]['caller_group'],
-                            'callee_group': calls[call_id]['callee_group'],
-                            'language': data.get('language', 'en')  # Pass language for transcription
+                            'from_user': call.from_user,
+                            'to_user': call.to_user,
+                            'caller_group': call.caller_group,
+                            'callee_group': call.callee_group,
+                            'language': data.get('language', 'en'),  # Pass language for transcription
+                            'chunk_ms': chunk_ms
                         })
+                        if transcription_backend and call_id in registry.calls:
+                            # Both parties stream PCM to the backend that owns the call
+                            for participant in call.participants:
+                                if participant.ws.state == State.OPEN:
+                                    await participant.ws.send(json.dumps({
+                                        'event': 'transcription_backend',
+                                        'call_id': call_id,
+                                        'url': transcription_backend.url
+                                    }))
                     else:
                         await websocket.send(json.dumps({'event': 'error', 'message': 'Call not found'}))
                 elif event == 'hang_up':
@@ -117,41 +201,23 @@ async def handle_websocket(websocket):
                     if not call_id:
                         await websocket.send(json.dumps({'event': 'error', 'message': 'Missing call_id'}))
                         continue
-                    if call_id in calls:
-                        caller_ws = calls[call_id]['caller_ws']
-                        callee_ws = calls[call_id]['callee_ws']
-                        del calls[call_id]
-                        for ws in [caller_ws, callee_ws]:
-                            if ws and ws.state == State.OPEN:
-                                await ws.send(json.dumps({'event': 'call_ended'}))
+                    call = registry.remove_call(call_id)
+                    if call:
+                        for participant in call.participants:
+                            if participant.ws.state == State.OPEN:
+                                await participant.ws.send(json.dumps({'event': 'call_ended'}))
                         await notify_both_services('call_ended', {'call_id': call_id})
                 elif event == 'logout':
-                    for group in users:
-                        if websocket in [u['ws'] for u in users[group].values()]:
-                            username = next(u for u, d in users[group].items() if d['ws'] == websocket)
-                            del users[group][username]
-                            if username in websocket_clients:
-                                del websocket_clients[username]
-                            await broadcast_user_status()
-                            await notify_both_services('logout', {'ip': client_ip})
-                            break
+                    await logout(connection)
             else:
                 logging.debug(f"Ignoring non-JSON message from {client_ip}")
+    except websockets.ConnectionClosed:
+        pass
     except Exception as e:
         logging.error(f"WebSocket error: {e}", exc_info=True)
-        for group in users:
-            if websocket in [u['ws'] for u in users[group].values()]:
-                username = next(u for u, d in users[group].items() if d['ws'] == websocket)
-                del users[group][username]
-                if username in websocket_clients:
-                    del websocket_clients[username]
-                await broadcast_user_status()
-                await notify_both_services('logout', {'ip': client_ip})
-                break
-        for call_id in list(calls.keys()):
-            if websocket in [calls[call_id]['caller_ws'], calls[call_id]['callee_ws']]:
-                del calls[call_id]
-                await notify_both_services('call_ended', {'call_id': call_id})
+    finally:
+        # Runs for every close, clean or not, and only touches this connection's entries
+        await disconnect(connection)
 
 async def serve_index(request):
     logging.debug(f"HTTP request from {request.remote} for /")
@@ -163,6 +229,7 @@ async def serve_index(request):
 async def init_app():
     app = web.Application()
     app.router.add_get('/', serve_index)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_static('/static/', path='static', name='static')
     app.router.add_static('/', path='.', name='root')
     return app
@@ -198,18 +265,15 @@ async def main():
         logging.error(f"Failed to start signaling WebSocket server on 8001: {e}")
         return
 
-    global udp_relay_socket, transcribe_socket
-    try:
-        udp_relay_socket = await websockets.connect('wss://localhost:8002', ssl=ssl_context_client)
-        logging.info("Connected to UDP relay server at wss://localhost:8002")
-    except Exception as e:
-        logging.error(f"Failed to connect to UDP relay server: {e}")
+    for url in UDP_RELAY_URLS:
+        try:
+            udp_relay_sockets[url] = await websockets.connect(url, ssl=ssl_context_client)
+            logging.info(f"Connected to UDP relay server at {url}")
+        except Exception as e:
+            logging.error(f"Failed to connect to UDP relay server {url}: {e}")
 
-    try:
-        transcribe_socket = await websockets.connect('wss://localhost:8003', ssl=ssl_context_client)
-        logging.info("Connected to transcription server at wss://localhost:8003")
-    except Exception as e:
-        logging.error(f"Failed to connect to transcription server: {e}")
+    await transcription_router.connect(ssl_context_client)
+    loop_task = asyncio.create_task(monitor_event_loop())
 
     await asyncio.Future()
 
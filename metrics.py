@@ -0,0 +1,181 @@
+import asyncio
+import bisect
+import logging
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class RateCounter:
+    # Message and byte counter for hot paths: add() is two integer additions;
+    # rates are only computed when someone asks for them.
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.last_messages = 0
+        self.last_bytes = 0
+        self.last_time = time.monotonic()
+
+    def add(self, nbytes):
+        self.messages += 1
+        self.bytes += nbytes
+
+    def rates(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        result = ((self.messages - self.last_messages) / elapsed, (self.bytes - self.last_bytes) / elapsed)
+        self.last_messages, self.last_bytes, self.last_time = self.messages, self.bytes, now
+        return result
+
+
+# Prometheus text-format metrics. Updating one is an attribute addition (or a
+# bisect for histograms) on an object resolved once, at import or when a
+# connection starts; all formatting happens in render(), at scrape time.
+# Gauges over live state (queue depths, active calls) take a callback instead
+# of being updated at all.
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, value=0):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    # A named family; children per label values are created on first use and
+    # should be kept by the caller rather than looked up per event
+    kinds = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+    def __init__(self, kind, name, help, labels=(), **options):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.options = options
+        self.children = {}
+        if not labels:
+            self.children[()] = self.kinds[kind](**options)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.kinds[self.kind](**self.options)
+        return child
+
+    def __getattr__(self, attr):
+        # Unlabelled metrics act as their only child: REQUESTS.inc()
+        if attr in ('inc', 'set', 'get', 'observe'):
+            return getattr(self.children[()], attr)
+        raise AttributeError(attr)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            labels = _labels(self.label_names, values)
+            if self.kind == 'histogram':
+                cumulative = 0
+                for le, count in zip(list(child.buckets) + ['+Inf'], child.counts):
+                    cumulative += count
+                    bucket_labels = _labels(self.label_names + ('le',), values + (le,))
+                    lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{self.name}_sum{labels} {child.sum}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+            else:
+                lines.append(f'{self.name}{labels} {child.get() if self.kind == "gauge" else child.value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, kind, name, help, labels=(), **options):
+        if name not in self.metrics:
+            self.metrics[name] = Metric(kind, name, help, tuple(labels), **options)
+        return self.metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self._add('counter', name, help, labels)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self._add('gauge', name, help, labels, fn=fn)
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._add('histogram', name, help, labels, buckets=tuple(buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines += metric.render()
+            except Exception as e:  # A broken callback must not take the whole scrape down
+                logger.error(f"Failed to render metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+EVENT_LOOP_LAG = REGISTRY.histogram('event_loop_lag_seconds', 'How late the event loop woke a periodic timer',
+                                    LATENCY_BUCKETS)
+
+
+async def monitor_event_loop(interval=0.5):
+    # Sleeps `interval` at a time; any extra delay is time the loop was busy
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.monotonic() - started - interval))
+
+
+async def metrics_handler(request):
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def serve_metrics(port, host='0.0.0.0'):
+    # Standalone /metrics listener for processes without an HTTP app of their own
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f"Failed to start metrics listener on {port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import vosk
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class ModelRegistry:
+    # Loads Vosk models on first use (or up front for a preload list) and evicts
+    # idle ones, least recently used first, once resident size passes the budget.
+    # Sessions hold a reference from acquire() to release(); only unreferenced
+    # models are ever evicted. Idle pooled recognizers hold references too, so
+    # before evicting a language the registry asks `reclaim` (the recognizer
+    # pool) to drop them.
+    def __init__(self, model_paths, memory_budget_mb=0):
+        self.model_paths = model_paths
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.models = OrderedDict()  # language -> model, least recently used first
+        self.refs = {}
+        self.stats = {}  # language -> {'load_seconds', 'rss_bytes'}
+        self.reclaim = None  # Optional callable(language, refs) -> references it gave up
+        self.lock = threading.Lock()  # Thread-mode workers may load concurrently
+
+    def preload(self, languages):
+        for language in languages:
+            self.acquire(language)
+            self.release(language)
+
+    def acquire(self, language):
+        with self.lock:
+            if language not in self.models:
+                self._load(language)
+            self.models.move_to_end(language)
+            self.refs[language] += 1
+            return self.models[language]
+
+    def release(self, language):
+        with self.lock:
+            if self.refs.get(language):
+                self.refs[language] -= 1
+                self.models.move_to_end(language)
+                self._evict(keep=None)
+
+    def report(self):
+        with self.lock:
+            return {language: dict(self.stats[language], sessions=self.refs[language]) for language in self.models}
+
+    def _load(self, language):
+        self._evict(keep=None)
+        rss_before = resident_bytes()
+        started = time.monotonic()
+        self.models[language] = vosk.Model(self.model_paths[language])
+        self.refs[language] = 0
+        self.stats[language] = {
+            'load_seconds': time.monotonic() - started,
+            'rss_bytes': max(0, resident_bytes() - rss_before)
+        }
+        logger.info(f"Loaded model {language} in {self.stats[language]['load_seconds']:.1f}s, "
+                    f"{self.stats[language]['rss_bytes'] / 2**20:.0f} MiB resident")
+        self._evict(keep=language)
+
+    def _evict(self, keep):
+        if not self.memory_budget:
+            return
+        for language in list(self.models):
+            if sum(stats['rss_bytes'] for stats in self.stats.values()) <= self.memory_budget:
+                break
+            if language == keep:
+                continue
+            if self.refs[language] and self.reclaim:
+                self.refs[language] -= self.reclaim(language, self.refs[language])
+            if self.refs[language] == 0:
+                # Recognizers still running hold their own reference in Vosk
+                del self.models[language]
+                del self.refs[language]
+                del self.stats[language]
+                logger.info(f"Evicted idle model {language} to stay within the memory budget")
@@ -0,0 +1,54 @@
+class PCMRingBuffer:
+    # Preallocated byte ring with read/write cursors. Reads hand out memoryview
+    # slices of the backing store; with a capacity that is a multiple of the
+    # read size, chunk reads never wrap and never copy.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.fill = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.fill
+
+    @property
+    def fill_ratio(self):
+        return self.fill / self.capacity
+
+    def write(self, data):
+        src = memoryview(data).cast('B')
+        n = len(src)
+        free = self.capacity - self.fill
+        if n > free:
+            # Drop the newest audio rather than overwrite unread data, which may
+            # be in the middle of being decoded on a worker.
+            self.dropped += n - free
+            n = free
+        first = min(n, self.capacity - self.write_pos)
+        self.view[self.write_pos:self.write_pos + first] = src[:first]
+        if n > first:
+            self.view[:n - first] = src[first:n]
+        self.write_pos = (self.write_pos + n) % self.capacity
+        self.fill += n
+        return n
+
+    def peek(self, n):
+        n = min(n, self.fill)
+        end = self.read_pos + n
+        if end <= self.capacity:
+            return self.view[self.read_pos:end]
+        return bytes(self.view[self.read_pos:]) + bytes(self.view[:end - self.capacity])
+
+    def consume(self, n):
+        n = min(n, self.fill)
+        self.read_pos = (self.read_pos + n) % self.capacity
+        self.fill -= n
+        return n
+
+    def drain(self):
+        data = bytes(self.peek(self.fill))
+        self.consume(self.fill)
+        return data
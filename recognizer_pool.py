@@ -0,0 +1,110 @@
+import threading
+
+import vosk
+
+
+class RecognizerPool:
+    # Idle KaldiRecognizers per (language, sample_rate, config), so a new call
+    # takes a ready one instead of building it from the model. Recognizers are
+    # Reset() when returned; at most max_idle are kept per key. When an
+    # acquire leaves fewer than min_idle, a background thread builds the
+    # replacements, so neither the new call nor the worker's queue waits on
+    # construction; only refill_languages (the preloaded ones) are topped up
+    # like that, others just keep what their calls return. Every recognizer,
+    # idle or not, holds a registry reference; the registry takes the idle
+    # ones back through drop_idle() when it needs to evict their language.
+    def __init__(self, registry, min_idle=2, max_idle=8, refill_languages=()):
+        self.registry = registry
+        self.refill_languages = set(refill_languages)
+        self.min_idle = min_idle
+        self.max_idle = max(min_idle, max_idle)
+        self.idle = {}  # (language, sample_rate, config) -> [recognizer]
+        self.stats = {}  # language -> {'hits', 'misses', 'discarded'}
+        self.warming = set()  # Keys with a refill thread running
+        self.lock = threading.Lock()  # Thread-mode workers share one pool
+
+    def _count(self, language, outcome, amount=1):
+        stats = self.stats.setdefault(language, {'hits': 0, 'misses': 0, 'discarded': 0})
+        stats[outcome] += amount
+
+    def _build(self, language, sample_rate, config):
+        return vosk.KaldiRecognizer(self.registry.acquire(language), sample_rate, config)
+
+    def acquire(self, language, sample_rate, config):
+        with self.lock:
+            idle = self.idle.get((language, sample_rate, config))
+            self._count(language, 'hits' if idle else 'misses')
+            recognizer = idle.pop() if idle else None
+        self._refill((language, sample_rate, config))
+        if recognizer is None:
+            recognizer = self._build(language, sample_rate, config)
+        return recognizer
+
+    def _refill(self, key):
+        if key[0] not in self.refill_languages:
+            return
+        with self.lock:
+            if len(self.idle.get(key, ())) >= self.min_idle or key in self.warming:
+                return
+            self.warming.add(key)
+
+        def refill():
+            try:
+                self.warm(*key)
+            finally:
+                with self.lock:
+                    self.warming.discard(key)
+
+        threading.Thread(target=refill, name=f'vosk-pool-{key[0]}', daemon=True).start()
+
+    def release(self, language, sample_rate, config, recognizer):
+        recognizer.Reset()
+        with self.lock:
+            idle = self.idle.setdefault((language, sample_rate, config), [])
+            if len(idle) < self.max_idle:
+                idle.append(recognizer)
+                return
+            self._count(language, 'discarded')
+        self.registry.release(language)
+
+    def discard(self, language):
+        # For recognizers that failed mid-use and can't be trusted after Reset()
+        with self.lock:
+            self._count(language, 'discarded')
+        self.registry.release(language)
+
+    def drop_idle(self, language, refs):
+        # Called by the registry, under its lock, when it wants to evict
+        # `language`. If idle recognizers hold all `refs` references (no call
+        # is using the model) they are forgotten and their count returned, for
+        # the registry to release itself; otherwise nothing is dropped.
+        with self.lock:
+            keys = [key for key in self.idle if key[0] == language]
+            if sum(len(self.idle[key]) for key in keys) != refs:
+                return 0
+            for key in keys:
+                del self.idle[key]
+            self._count(language, 'discarded', refs)
+            return refs
+
+    def warm(self, language, sample_rate, config):
+        key = (language, sample_rate, config)
+        while True:
+            with self.lock:
+                if len(self.idle.get(key, ())) >= self.min_idle:
+                    return
+            recognizer = self._build(language, sample_rate, config)
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(recognizer)
+                    continue
+            self.registry.release(language)  # Calls ended and refilled the pool meanwhile
+            return
+
+    def report(self):
+        with self.lock:
+            report = {language: dict(stats, idle=0) for language, stats in self.stats.items()}
+            for (language, _, _), idle in self.idle.items():
+                report.setdefault(language, {'hits': 0, 'misses': 0, 'discarded': 0, 'idle': 0})['idle'] += len(idle)
+            return report
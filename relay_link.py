@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import struct
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Channel between relay worker processes, over Unix sockets. Each worker
+# listens on its own socket and connects out to every other worker, so each
+# direction of a worker pair is one ordered stream of records:
+#   AUDIO  a frame for the named client, which is connected to the receiver
+#   HERE   the named client is now connected to the sender (payload: its index)
+#   GONE   the named client left the sender
+AUDIO, HERE, GONE = 0, 1, 2
+HEADER = struct.Struct('!BHI')  # kind, name length, payload length
+INDEX = struct.Struct('!H')
+LINK_BUFFER_BYTES = 4 * 1024 * 1024  # Unsent bytes per link before frames for remote peers are dropped
+
+LINK_DROPS = REGISTRY.counter('relay_link_dropped_total', 'Frames for remote peers dropped on a backed-up worker link').labels()
+LINK_FRAMES = REGISTRY.counter('relay_link_frames_total', 'Frames handed to another relay worker').labels()
+
+
+def socket_path(link_dir, index):
+    return os.path.join(link_dir, f'worker-{index}.sock')
+
+
+class WorkerLink:
+    # Sending half of the channel to one other worker. send() never waits: it
+    # writes into the transport buffer, or drops the frame if that is backed up.
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.writer = None
+
+    async def connect(self, on_connect, retry_interval=0.1):
+        while self.writer is None:
+            try:
+                _, self.writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(retry_interval)  # That worker is still starting
+        logger.info(f"Linked to relay worker {self.index}")
+        on_connect(self)
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    def send(self, kind, username, payload=b''):
+        if not self.connected:
+            return False
+        if kind == AUDIO and self.writer.transport.get_write_buffer_size() > LINK_BUFFER_BYTES:
+            LINK_DROPS.inc()
+            return False
+        name = username.encode()
+        self.writer.writelines((HEADER.pack(kind, len(name), len(payload)), name, payload))
+        return True
+
+
+class RemoteRoute:
+    # Stands in for a peer's outbox when the peer is connected to another worker
+    __slots__ = ('link', 'username')
+
+    def __init__(self, link, username):
+        self.link = link
+        self.username = username
+
+    def offer(self, item):
+        LINK_FRAMES.inc()
+        return self.link.send(AUDIO, self.username, item[0])
+
+
+async def serve_links(path, on_audio, on_here, on_gone):
+    # Receiving half: one reader per connected worker, dispatching records
+    # to the relay's callbacks
+    async def handle(reader, writer):
+        try:
+            while True:
+                kind, name_length, payload_length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                username = (await reader.readexactly(name_length)).decode()
+                payload = await reader.readexactly(payload_length) if payload_length else b''
+                if kind == AUDIO:
+                    on_audio(username, payload)
+                elif kind == HERE:
+                    on_here(username, INDEX.unpack(payload)[0])
+                elif kind == GONE:
+                    on_gone(username, INDEX.unpack(payload)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path)
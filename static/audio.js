@@ -8,17 +8,21 @@ const ringback = new Audio('/static/ringback.mp3');
 ringback.loop = true;
 
 const DEBUG = false;
+const PCM_FRAME_MS = 40; // Requested PCM uplink frame size; the transcription server may clamp it
+let pcmFrameMs = null; // Frame size accepted by the transcription server, null until negotiated
+const onlineUsers = { sales: new Set(), customers: new Set() }; // Last user_status snapshot with deltas applied
 
 let mediaSource, sourceBuffer, chunkQueue = [], isProcessing = false;
+let transcribeUrl = `wss://${host}:8003`; // Transcription backend; the signaling server may move us per call
 
 async function initAudio() {
     socket = new WebSocket(`wss://${host}:8001`, [], { pingInterval: 30000 });
     udpSocket = new WebSocket(`wss://${host}:8002`, [], { pingInterval: 30000 });
-    transcribeSocket = new WebSocket(`wss://${host}:8003`, [], { pingInterval: 30000 });
+    connectTranscription(transcribeUrl);
     audioElement = document.createElement('audio');
     audioElement.autoplay = true;
     document.body.appendChild(audioElement);
-    audioContext = new AudioContext({ sampleRate: 16000 });
+    audioContext = new AudioContext(); // Native rate; the transcription server resamples
 
     mediaSource = new MediaSource();
     audioElement.src = URL.createObjectURL(mediaSource);
@@ -43,17 +47,6 @@ async function initAudio() {
             }));
         }
     };
-    transcribeSocket.onopen = () => {
-        if (DEBUG) console.log('Transcription WebSocket opened');
-        if (currentCall.group && currentCall.username) {
-            transcribeSocket.send(JSON.stringify({
-                event: 'register',
-                group: currentCall.group,
-                username: currentCall.username,
-                language: currentCall.language
-            }));
-        }
-    };
 
     socket.onmessage = async (event) => {
         const data = JSON.parse(event.data);
@@ -63,10 +56,17 @@ async function initAudio() {
                 document.cookie = `session_id=${data.session_id}; path=/`;
                 break;
             case 'user_status':
-                document.getElementById('sales-list').dataset.users = data.sales.join(',');
-                document.getElementById('customers-list').dataset.users = data.customers.join(',');
-                updateUserList('sales-list', data.sales);
-                updateUserList('customers-list', data.customers);
+                onlineUsers.sales = new Set(data.sales);
+                onlineUsers.customers = new Set(data.customers);
+                showOnlineUsers();
+                break;
+            case 'user_status_delta':
+                // Deltas apply on top of the last snapshot
+                for (const group of ['sales', 'customers']) {
+                    (data.joined[group] || []).forEach(user => onlineUsers[group].add(user));
+                    (data.left[group] || []).forEach(user => onlineUsers[group].delete(user));
+                }
+                showOnlineUsers();
                 break;
             case 'incoming_call':
                 currentCall.peer = { user: data.from_user };
@@ -81,6 +81,9 @@ async function initAudio() {
                 ringback.currentTime = 0;
                 startAudioStream();
                 break;
+            case 'transcription_backend':
+                switchTranscriptionBackend(data.url);
+                break;
             case 'call_ended':
                 await endCall();
                 break;
@@ -100,24 +103,54 @@ async function initAudio() {
         }
     };
 
+    socket.onclose = async () => {
+        console.warn('Signaling WebSocket closed—reconnecting');
+        socket = new WebSocket(`wss://${host}:8001`, [], { pingInterval: 30000 });
+        await new Promise(resolve => socket.onopen = resolve);
+        if (currentCall.username) register(currentCall.group, currentCall.username);
+    };
+    udpSocket.onclose = async () => {
+        console.warn('UDP relay WebSocket closed—reconnecting');
+        udpSocket = new WebSocket(`wss://${host}:8002`, [], { pingInterval: 30000 });
+        await new Promise(resolve => udpSocket.onopen = resolve);
+    };
+}
+
+function transcriptionRegistration(group, username, language) {
+    // The same register message on first login and on every reconnect
+    return JSON.stringify({
+        event: 'register',
+        group: group,
+        username: username,
+        language: language,
+        pcm_frame_ms: PCM_FRAME_MS,
+        sample_rate: audioContext.sampleRate,
+        format: 'f32le', // Raw worklet samples; the server converts to 16 kHz int16
+        incremental: true // Partials may arrive as a suffix from 'offset'
+    });
+}
+
+function connectTranscription(url) {
+    transcribeUrl = url;
+    transcribeSocket = new WebSocket(url, [], { pingInterval: 30000 });
+    transcribeSocket.onopen = () => {
+        if (DEBUG) console.log('Transcription WebSocket opened');
+        if (currentCall.group && currentCall.username) {
+            transcribeSocket.send(transcriptionRegistration(currentCall.group, currentCall.username, currentCall.language));
+        }
+    };
     transcribeSocket.onmessage = async (event) => {
         const data = JSON.parse(event.data);
+        if (data.event === 'registered') {
+            pcmFrameMs = data.pcm_frame_ms;
+            if (DEBUG) console.log('PCM uplink frame size negotiated:', pcmFrameMs);
+            return;
+        }
         if (currentCall.group === 'sales' && currentCall.call_id === data.call_id) {
-            if (data.event === 'transcription') {
-                console.log('Transcription received:', data);
-                const targetPartial = data.group === 'sales' ? 'sales-partial' : 'customer-partial';
-                const targetFinals = data.group === 'sales' ? 'sales-finals' : 'customer-finals';
-                if (!data.is_final) {
-                    document.getElementById(targetPartial).value = data.text;
-                } else {
-                    document.getElementById(targetPartial).value = '';
-                    const p = document.createElement('p');
-                    p.textContent = data.text;
-                    document.getElementById(targetFinals).appendChild(p);
-                    document.getElementById(targetFinals).scrollTop = document.getElementById(targetFinals).scrollHeight;
-                    currentCall.transcripts[data.group === 'sales' ? 'sales' : 'customers'].push(data.text);
-                }
-                document.getElementById('transcription').classList.remove('d-none');
+            if (data.event === 'transcription_batch') {
+                data.items.forEach(showTranscription);
+            } else if (data.event === 'transcription') {
+                showTranscription(data);
             } else if (data.event === 'insight') {
                 const insightDiv = document.getElementById('insights');
                 const p = document.createElement('p');
@@ -127,25 +160,43 @@ async function initAudio() {
             }
         }
     };
-
-    socket.onclose = async () => {
-        console.warn('Signaling WebSocket closed—reconnecting');
-        socket = new WebSocket(`wss://${host}:8001`, [], { pingInterval: 30000 });
-        await new Promise(resolve => socket.onopen = resolve);
-        if (currentCall.username) register(currentCall.group, currentCall.username);
-    };
-    udpSocket.onclose = async () => {
-        console.warn('UDP relay WebSocket closed—reconnecting');
-        udpSocket = new WebSocket(`wss://${host}:8002`, [], { pingInterval: 30000 });
-        await new Promise(resolve => udpSocket.onopen = resolve);
-    };
-    transcribeSocket.onclose = async () => {
+    transcribeSocket.onclose = (event) => {
+        if (event.target !== transcribeSocket) return; // Closed on purpose after switching backends
         console.warn('Transcription WebSocket closed—reconnecting');
-        transcribeSocket = new WebSocket(`wss://${host}:8003`, [], { pingInterval: 30000 });
-        await new Promise(resolve => transcribeSocket.onopen = resolve);
+        setTimeout(() => connectTranscription(transcribeUrl), 1000);
     };
 }
 
+function showTranscription(data) {
+    if (DEBUG) console.log('Transcription received:', data);
+    const targetPartial = data.group === 'sales' ? 'sales-partial' : 'customer-partial';
+    const targetFinals = data.group === 'sales' ? 'sales-finals' : 'customer-finals';
+    if (!data.is_final) {
+        const partial = document.getElementById(targetPartial);
+        partial.value = data.offset === undefined ? data.text : partial.value.slice(0, data.offset) + data.text;
+    } else {
+        document.getElementById(targetPartial).value = '';
+        const p = document.createElement('p');
+        p.textContent = data.text;
+        document.getElementById(targetFinals).appendChild(p);
+        document.getElementById(targetFinals).scrollTop = document.getElementById(targetFinals).scrollHeight;
+        currentCall.transcripts[data.group === 'sales' ? 'sales' : 'customers'].push(data.text);
+    }
+    document.getElementById('transcription').classList.remove('d-none');
+}
+
+function switchTranscriptionBackend(backendUrl) {
+    // Backend URLs are as seen by the signaling server; localhost means the host serving this page
+    const url = new URL(backendUrl);
+    if (['localhost', '127.0.0.1'].includes(url.hostname)) url.hostname = host;
+    const target = `${url.protocol}//${url.host}`;
+    if (target === transcribeUrl) return;
+    if (DEBUG) console.log('Switching transcription backend to', target);
+    const previous = transcribeSocket;
+    connectTranscription(target);
+    previous.close();
+}
+
 function processQueue() {
     if (isProcessing || !sourceBuffer || mediaSource.readyState !== 'open') {
         if (DEBUG) console.log('Queue waiting: processing or not ready');
@@ -196,12 +247,7 @@ function register(group = null, username = null) {
         }));
     }
     if (transcribeSocket.readyState === WebSocket.OPEN) {
-        transcribeSocket.send(JSON.stringify({
-            event: 'register',
-            group: group,
-            username: username,
-            language: language
-        }));
+        transcribeSocket.send(transcriptionRegistration(group, username, language));
     }
     currentCall.group = group;
     currentCall.username = username;
@@ -288,7 +334,7 @@ async function endCall() {
         await audioContext.close();
     }
     recorder = null;
-    audioContext = new AudioContext({ sampleRate: 16000 });
+    audioContext = new AudioContext(); // Native rate; the transcription server resamples
     if (mediaSource.readyState === 'open') {
         mediaSource.endOfStream();
     }
@@ -309,8 +355,7 @@ async function endCall() {
     document.getElementById('call-controls').classList.add('d-none');
     currentCall.call_id = null;
     currentCall.peer = null;
-    updateUserList('sales-list', document.getElementById('sales-list').dataset.users?.split(',') || []);
-    updateUserList('customers-list', document.getElementById('customers-list').dataset.users?.split(',') || []);
+    showOnlineUsers();
     if (DEBUG) console.log('MediaSource reset');
 }
 
@@ -318,6 +363,11 @@ function showCallControls() {
     document.getElementById('call-controls').classList.remove('d-none');
 }
 
+function showOnlineUsers() {
+    updateUserList('sales-list', [...onlineUsers.sales]);
+    updateUserList('customers-list', [...onlineUsers.customers]);
+}
+
 function updateUserList(elementId, users) {
     const list = document.getElementById(elementId);
     list.innerHTML = '';
@@ -361,7 +411,6 @@ async function startAudioStream() {
     try {
         const stream = await navigator.mediaDevices.getUserMedia({
             audio: {
-                sampleRate: 16000,
                 noiseSuppression: true,
                 echoCancellation: true,
                 autoGainControl: true
@@ -385,15 +434,16 @@ async function startAudioStream() {
         recorder.start(20);
 
         await audioContext.audioWorklet.addModule('/static/audioWorklet.js');
+        // Without a negotiated frame size, fall back to one render quantum per message
+        const frameSamples = pcmFrameMs ? Math.round(audioContext.sampleRate * pcmFrameMs / 1000) : 128;
         const pcmNode = new AudioWorkletNode(audioContext, 'pcm-processor', {
-            processorOptions: { bufferSize: 1024 }
+            processorOptions: { frameSamples: frameSamples }
         });
         pcmNode.port.onmessage = (event) => {
-            const pcmBlob = new Blob([event.data], { type: 'audio/pcm' });
             if (DEBUG) console.log('PCM chunk, first 10 samples:', event.data.slice(0, 10));
             if (transcribeSocket.readyState === WebSocket.OPEN) {
-                transcribeSocket.send(pcmBlob);
-                if (DEBUG) console.log('Sent PCM packet for transcription (sales only):', pcmBlob.size);
+                transcribeSocket.send(event.data);
+                if (DEBUG) console.log('Sent PCM packet for transcription (sales only):', event.data.byteLength);
             }
         };
         sourceNode.connect(pcmNode);
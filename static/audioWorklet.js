@@ -1,23 +1,36 @@
 class PCMProcessor extends AudioWorkletProcessor {
-    constructor() {
+    constructor(options) {
         super();
+        // Coalesce render quanta (128 samples) into frames of frameSamples
+        // before posting, so the uplink carries a few larger messages instead
+        // of hundreds of tiny ones per second.
+        const frameSamples = options.processorOptions?.frameSamples || 128;
+        this.frame = new Float32Array(frameSamples);
+        this.offset = 0;
     }
 
     process(inputs, outputs) {
         const input = inputs[0][0]; // First channel input
-        const int16Data = new Int16Array(input.length);
+        if (!input) return true;
 
-        for (let i = 0; i < input.length; i++) {
-            // Apply 2x gain
-            let sample = input[i] * 32767 * 2;
-            int16Data[i] = Math.max(-32768, Math.min(32767, Math.round(sample)));
+        // Samples go out as captured (float32 at the context's native rate);
+        // resampling, gain and int16 conversion happen on the server
+        let consumed = 0;
+        while (consumed < input.length) {
+            const count = Math.min(input.length - consumed, this.frame.length - this.offset);
+            this.frame.set(input.subarray(consumed, consumed + count), this.offset);
+            this.offset += count;
+            consumed += count;
+            if (this.offset === this.frame.length) {
+                // Send PCM data, handing the buffer over instead of copying it
+                this.port.postMessage(this.frame, [this.frame.buffer]);
+                this.frame = new Float32Array(this.frame.length);
+                this.offset = 0;
+            }
         }
 
-        // Send PCM data
-        this.port.postMessage(int16Data);
-
         return true;
     }
 }
 
-registerProcessor('pcm-processor', PCMProcessor);
\ No newline at end of file
+registerProcessor('pcm-processor', PCMProcessor);
@@ -1,49 +1,129 @@
+import argparse
 import asyncio
 import json
 import logging
+import os
+import signal
 import ssl
+import time
 import websockets
-from websockets import State
 from vosk_asr import VoskASR
-from collections import defaultdict
+from call_index import CallIndex
+from metrics import RateCounter, REGISTRY, monitor_event_loop, serve_metrics
+from bounded_queue import BoundedQueue, DROP_OLDEST, POLICIES
+from transcript_delivery import TranscriptDelivery
+from audio_ingest import AudioIngest, S16LE, validate_format
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 transcribe_clients = {}
+control_clients = set()  # Signaling servers that receive our load reports
 calls = {}
+stream_tasks = set()  # One per speaker; outlives its call until the recognizer is finalized
+draining = False
+call_index = CallIndex()
 asr = VoskASR()
+pcm_ingress = RateCounter()
+delivery = TranscriptDelivery(transcribe_clients)
 
-async def transcribe_audio(call_id):
-    logger.info(f"Starting transcription task for {call_id}")
-    last_partials = defaultdict(str)
-    while call_id in calls:
-        queue = calls[call_id].get('queue')
-        if queue:
-            group, pcm_data, username = await queue.get()
+# Clients may coalesce PCM into larger uplink frames, negotiated at register
+MIN_PCM_FRAME_MS = 20
+MAX_PCM_FRAME_MS = 100
+STATS_REPORT_INTERVAL = 10  # seconds
+
+# Clients that declare sample_rate (and format) at register send audio as
+# captured; the ingest stage resamples and normalizes it for the recognizer,
+# a batch of queued frames at a time. Clients that declare nothing are taken
+# to send 16 kHz 16-bit PCM and are passed through untouched.
+INGEST_NORMALIZE = os.environ.get('TRANSCRIBE_NORMALIZE', '1') != '0'
+INGEST_BATCH_FRAMES = 10  # Most frames converted in one batch
+
+# Per-stream audio queues are bounded; when recognition falls behind the
+# policy (drop-oldest, drop-newest or catch-up) decides what is thrown away.
+QUEUE_FRAMES = int(os.environ.get('TRANSCRIBE_QUEUE_FRAMES', 100))
+QUEUE_POLICY = os.environ.get('TRANSCRIBE_QUEUE_POLICY', DROP_OLDEST)
+
+# Concurrent calls this backend advertises to the signaling server for placement
+CAPACITY = int(os.environ.get('TRANSCRIBE_CAPACITY', 0)) or asr.workers.size * 4
+LOAD_REPORT_INTERVAL = 2  # seconds
+
+FRAMES_IN = REGISTRY.counter('transcribe_frames_received_total', 'PCM frames received from clients').labels()
+BYTES_IN = REGISTRY.counter('transcribe_bytes_received_total', 'PCM bytes received from clients').labels()
+QUEUE_DROPS = REGISTRY.counter('transcribe_queue_dropped_total', 'PCM frames dropped by full stream queues').labels()
+INGEST_BATCHES = REGISTRY.counter('transcribe_ingest_batches_total', 'Batches through the resampling stage').labels()
+INGEST_SECONDS = REGISTRY.counter('transcribe_ingest_seconds_total', 'Time spent resampling and normalizing audio').labels()
+# Model gauges cover every worker (each process-mode worker loads its own
+# copy), so they are collected from the workers with the periodic stats
+# report rather than at scrape time
+MODEL_RESIDENT = REGISTRY.gauge('asr_model_resident_bytes', 'Resident memory added by loading the model, all workers',
+                                ('language',))
+MODEL_LOAD_SECONDS = REGISTRY.gauge('asr_model_load_seconds', 'Slowest load of the model among workers holding it',
+                                    ('language',))
+MODEL_WORKERS = REGISTRY.gauge('asr_model_loaded_workers', 'Workers with the model loaded', ('language',))
+REGISTRY.gauge('transcribe_active_calls', 'Calls being transcribed', fn=lambda: len(calls))
+REGISTRY.gauge('transcribe_clients', 'Registered transcription clients', fn=lambda: len(transcribe_clients))
+REGISTRY.gauge('transcribe_queue_depth', 'PCM frames waiting in all stream queues',
+               fn=lambda: sum(queue.qsize() for call in list(calls.values()) for queue in call['queues'].values()))
+REGISTRY.gauge('transcribe_lag_seconds_max', 'How far the most delayed stream is behind live audio',
+               fn=lambda: max((lag for call in list(calls.values()) for lag in call['lag'].values()), default=0.0))
+REGISTRY.gauge('transcribe_draining', '1 while shutting down and refusing new calls', fn=lambda: int(draining))
+
+async def transcribe_audio(call_id, group):
+    logger.info(f"Starting transcription task for {call_id} ({group})")
+    last_partial = ""
+    queue = calls[call_id]['queues'][group]
+    ingest = None
+    carried = None  # Item dequeued while batching that belongs to the next round
+    try:
+        while call_id in calls:
+            item, carried = carried or await queue.get(), None
+            pcm_data, username, queued_at, audio_format = item
             if pcm_data is None:  # Signal to stop
                 break
-            logger.debug(f"Processing PCM for {call_id} (group: {group}, user: {username}): {len(pcm_data)} bytes")
-            transcript, is_final = await asr.process_audio(call_id, pcm_data, username)
-            if transcript and (is_final or transcript != last_partials[group]):
-                call = calls[call_id]
+            if audio_format:
+                # Frames queued behind this one are converted in the same batch, up
+                # to the sentinel or a frame sent after re-registering another format
+                frames = [pcm_data]
+                while len(frames) < INGEST_BATCH_FRAMES and not queue.empty():
+                    item = queue.get_nowait()
+                    if item[3] != audio_format:
+                        carried = item
+                        break
+                    queue.task_done()
+                    frames.append(item[0])
+                if ingest is None or ingest.spec != audio_format:
+                    ingest = AudioIngest(*audio_format, target_rate=asr.target_rate, normalize=INGEST_NORMALIZE)
+                started = time.perf_counter()
+                pcm_data = ingest.process(frames)
+                INGEST_SECONDS.inc(time.perf_counter() - started)
+                INGEST_BATCHES.inc()
+            transcript, is_final = await asr.process_audio(call_id, group, pcm_data, username)
+            backlog = asr.backlog(call_id, group)
+            call = calls.get(call_id)
+            if call and backlog:
+                # Lag: time this frame waited in the queue plus audio still buffered ahead of the recognizer
+                call['lag'][group] = time.monotonic() - queued_at + backlog['bytes'] / (asr.target_rate * 2)
+            if call and transcript and (is_final or transcript != last_partial):
                 sales_users = [call['caller']] if call['caller_group'] == 'sales' else []
                 if call['callee_group'] == 'sales':
                     sales_users.append(call['callee'])
-                for user in sales_users:
-                    client = transcribe_clients.get(user)
-                    if client and client['ws'].state == State.OPEN:
-                        await client['ws'].send(json.dumps({
-                            'event': 'transcription',
-                            'call_id': call_id,
-                            'group': group,
-                            'text': transcript,
-                            'is_final': is_final
-                        }))
-                        logger.info(f"Sent transcription to {user}: {transcript} (group: {group})")
-                last_partials[group] = transcript if not is_final else ""
+                delivery.publish(sales_users, call_id, group, transcript, is_final)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Transcript for {call_id} ({group}, final={is_final}): {transcript}")
+                last_partial = transcript if not is_final else ""
             queue.task_done()
-    logger.info(f"Stopped transcription for {call_id}")
+    except Exception as e:
+        logger.error(f"Transcription task for {call_id} ({group}) failed: {e}", exc_info=True)
+    finally:
+        # Finalized here rather than in call_ended: the control connection never
+        # waits on the worker, and nothing is still decoding from the buffer.
+        # Also on failure, so the recognizer and worker slot are returned.
+        try:
+            await asr.end_session(call_id, group)
+        finally:
+            delivery.end_stream(call_id, group)
+    logger.info(f"Stopped transcription for {call_id} ({group})")
 
 async def transcribe(websocket):
     client_ip = websocket.remote_address[0]
@@ -55,11 +135,39 @@ async def transcribe(websocket):
                 event = data.get('event')
                 logger.info(f"Received control message from {client_ip}: {data}")
                 if event == 'register':
+                    # A rejected register leaves any earlier registration on this socket in place
+                    if not data.get('group') or not data.get('username'):
+                        await websocket.send(json.dumps({'event': 'error', 'message': 'Missing group or username'}))
+                        continue
+                    audio_format = None
+                    if 'sample_rate' in data:
+                        try:
+                            audio_format = validate_format(data['sample_rate'], data.get('format', S16LE))
+                        except ValueError as e:
+                            await websocket.send(json.dumps({'event': 'error', 'message': str(e)}))
+                            continue
+                    previous = transcribe_clients.get(username)
+                    if previous and previous['ws'] is websocket and username != data['username']:
+                        del transcribe_clients[username]  # Re-registered under another name
                     group = data['group']
                     username = data['username']
                     language = data.get('language', 'en')
-                    transcribe_clients[username] = {'ws': websocket, 'language': language, 'group': group}
+                    transcribe_clients[username] = {'ws': websocket, 'language': language, 'group': group,
+                                                    'incremental': bool(data.get('incremental')),
+                                                    'audio_format': audio_format}
                     logger.info(f"Registered {username} from {client_ip} as {group}")
+                    if 'pcm_frame_ms' in data:
+                        try:
+                            frame_ms = min(max(int(data['pcm_frame_ms']), MIN_PCM_FRAME_MS), MAX_PCM_FRAME_MS)
+                        except (TypeError, ValueError):
+                            # Registered all the same; the client keeps its default frame size
+                            await websocket.send(json.dumps({'event': 'error', 'message': 'Invalid pcm_frame_ms'}))
+                            continue
+                        await websocket.send(json.dumps({'event': 'registered', 'pcm_frame_ms': frame_ms}))
+                elif event == 'backend_hello':
+                    control_clients.add(websocket)
+                    await websocket.send(load_report())
+                    logger.info(f"Reporting load to signaling server at {client_ip}")
                 elif event == 'call_accepted':
                     call_id = data['call_id']
                     calls[call_id] = {
@@ -67,39 +175,141 @@ async def transcribe(websocket):
                         'callee': data['to_user'],
                         'caller_group': data['caller_group'],
                         'callee_group': data['callee_group'],
-                        'queue': asyncio.Queue()
+                        # One queue, recognizer and task per speaker
+                        'queues': {
+                            data['caller_group']: BoundedQueue(QUEUE_FRAMES, QUEUE_POLICY, QUEUE_DROPS),
+                            data['callee_group']: BoundedQueue(QUEUE_FRAMES, QUEUE_POLICY, QUEUE_DROPS)
+                        },
+                        'lag': {data['caller_group']: 0.0, data['callee_group']: 0.0},
+                        'reported_drops': 0
                     }
-                    asr.start_session(call_id, data.get('language', 'en'))
-                    asyncio.create_task(transcribe_audio(call_id))
+                    call_index.add(call_id, data['from_user'], data['to_user'])
+                    for stream_group in calls[call_id]['queues']:
+                        asr.start_session(call_id, stream_group, data.get('language', 'en'), data.get('chunk_ms'))
+                        task = asyncio.create_task(transcribe_audio(call_id, stream_group))
+                        stream_tasks.add(task)
+                        task.add_done_callback(stream_tasks.discard)
                     logger.info(f"Started transcription for {call_id}")
                 elif event == 'call_ended':
                     call_id = data.get('call_id')
                     if call_id in calls:
-                        asr.end_session(call_id)
-                        await calls[call_id]['queue'].put((None, None, None))  # Signal task to stop
+                        call_index.remove(call_id)
+                        for queue in calls[call_id]['queues'].values():
+                            queue.close((None, None, None, None))  # Signal task to stop; it ends the ASR session
                         del calls[call_id]
                         logger.info(f"Ended transcription for {call_id}")
             elif isinstance(message, (bytes, bytearray)):
+                pcm_ingress.add(len(message))
+                FRAMES_IN.inc()
+                BYTES_IN.inc(len(message))
                 if username:
-                    call_id = next((cid for cid, call in calls.items() if username in (call['caller'], call['callee'])), None)
-                    if call_id:
-                        group = transcribe_clients[username]['group']
-                        logger.debug(f"Queuing PCM for {call_id} from {username} (group: {group}): {len(message)} bytes")
-                        await calls[call_id]['queue'].put((group, message, username))
+                    call_id = call_index.call_of(username)
+                    client = transcribe_clients.get(username)
+                    if call_id in calls and client and client['ws'] is websocket:
+                        queue = calls[call_id]['queues'].get(client['group'])
+                        if queue:
+                            # The format travels with the frame; the client may be gone when it is dequeued
+                            queue.offer((message, username, time.monotonic(), client['audio_format']))
     except Exception as e:
         logger.error(f"Transcription error: {e}", exc_info=True)
     finally:
-        if username and username in transcribe_clients:
-            del transcribe_clients[username]
+        control_clients.discard(websocket)
+        if username and transcribe_clients.get(username, {}).get('ws') is websocket:
+            del transcribe_clients[username]  # Unless the user has since registered from another socket
             logger.warning(f"Disconnected {username} ({client_ip})")
 
-async def transcribe_server():
+async def report_stats():
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        messages_per_sec, bytes_per_sec = pcm_ingress.rates()
+        logger.info(f"PCM ingress: {messages_per_sec:.0f} msg/s, {bytes_per_sec / 1024:.1f} KiB/s "
+                    f"({bytes_per_sec / messages_per_sec if messages_per_sec else 0:.0f} bytes/msg)")
+        results, messages, failures = delivery.stats()
+        if results:
+            logger.info(f"Transcripts: {results} results in {messages} messages, {failures} failed sends "
+                        f"in the last {STATS_REPORT_INTERVAL}s")
+        pools = {}
+        for report in await asr.workers.pool_stats():
+            for language, stats in report.items():
+                totals = pools.setdefault(language, dict.fromkeys(stats, 0))
+                for name, value in stats.items():
+                    totals[name] += value
+        for language, totals in pools.items():
+            logger.info(f"Recognizer pool {language}: {totals['hits']} hits, {totals['misses']} misses, "
+                        f"{totals['discarded']} discarded, {totals['idle']} idle")
+        await report_models()
+        for call_id, call in list(calls.items()):
+            drops = sum(queue.dropped for queue in call['queues'].values())
+            if drops > call['reported_drops']:
+                lag = max(call['lag'].values())
+                logger.warning(f"Call {call_id} is {lag:.2f}s behind; dropped {drops - call['reported_drops']} "
+                               f"frames ({QUEUE_POLICY}) in the last {STATS_REPORT_INTERVAL}s, {drops} total")
+                call['reported_drops'] = drops
+
+async def report_models():
+    models = {}
+    for report in await asr.workers.model_stats():
+        for language, stats in report.items():
+            totals = models.setdefault(language, {'workers': 0, 'rss_bytes': 0, 'load_seconds': 0.0, 'sessions': 0})
+            totals['workers'] += 1
+            totals['rss_bytes'] += stats['rss_bytes']
+            totals['load_seconds'] = max(totals['load_seconds'], stats['load_seconds'])
+            totals['sessions'] += stats['sessions']
+    for language in asr.model_paths:
+        totals = models.get(language)
+        MODEL_WORKERS.labels(language).set(totals['workers'] if totals else 0)
+        MODEL_RESIDENT.labels(language).set(totals['rss_bytes'] if totals else 0)
+        if totals:
+            MODEL_LOAD_SECONDS.labels(language).set(round(totals['load_seconds'], 3))
+            logger.info(f"Model {language}: loaded on {totals['workers']} workers, "
+                        f"{totals['rss_bytes'] / 2**20:.0f} MiB resident, {totals['load_seconds']:.1f}s to load, "
+                        f"{totals['sessions']} references (sessions and idle recognizers)")
+
+def load_report():
+    return json.dumps({'event': 'load', 'calls': len(calls), 'capacity': CAPACITY, 'draining': draining})
+
+async def report_load():
+    while True:
+        await asyncio.sleep(LOAD_REPORT_INTERVAL)
+        websockets.broadcast(control_clients, load_report())
+
+async def drain(stopped):
+    # Stop taking new calls (the signaling server routes around us once it sees
+    # the report) and exit when the running ones have ended
+    global draining
+    if draining:
+        return
+    draining = True
+    logger.warning(f"Draining: waiting for {len(calls)} calls to end")
+    websockets.broadcast(control_clients, load_report())
+    while calls or stream_tasks:
+        await asyncio.sleep(1)
+    logger.info("Drained, shutting down")
+    stopped.set_result(None)
+
+async def transcribe_server(port=8003, metrics_port=9103):
+    if QUEUE_POLICY not in POLICIES:
+        raise ValueError(f"Unknown TRANSCRIBE_QUEUE_POLICY: {QUEUE_POLICY}. Supported: {', '.join(POLICIES)}")
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
-    server = websockets.serve(transcribe, '0.0.0.0', 8003, ssl=ssl_context)
+    server = websockets.serve(transcribe, '0.0.0.0', port, ssl=ssl_context)
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    drain_tasks = []
+    loop.add_signal_handler(signal.SIGTERM, lambda: drain_tasks.append(asyncio.create_task(drain(stopped))))
+    if metrics_port:
+        await serve_metrics(metrics_port)
     async with server:
-        logger.info("Transcription WebSocket started on wss://0.0.0.0:8003")
-        await asyncio.Future()
+        stats_task = asyncio.create_task(report_stats())
+        load_task = asyncio.create_task(report_load())
+        loop_task = asyncio.create_task(monitor_event_loop())
+        logger.info(f"Transcription WebSocket started on wss://0.0.0.0:{port}")
+        await stopped
 
 if __name__ == '__main__':
-    asyncio.run(transcribe_server())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Vosk transcription server")
+    parser.add_argument('--port', type=int, default=8003)
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('TRANSCRIBE_METRICS_PORT', 9103)),
+                        help="HTTP port for /metrics, 0 to disable")
+    args = parser.parse_args()
+    asyncio.run(transcribe_server(args.port, args.metrics_port))
\ No newline at end of file
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+
+import websockets
+from websockets import State
+from metrics import REGISTRY
+
+try:
+    import orjson
+except ImportError:  # Optional; the stdlib encoder produces the same JSON, only slower
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Results for one client within DELIVERY_WINDOW_MS go out as one message; 0
+# sends each result as soon as it is published
+DELIVERY_WINDOW_MS = int(os.environ.get('TRANSCRIPT_WINDOW_MS', 20))
+# Clients that register with incremental=true get partials as the changed
+# suffix only: {'offset': n, 'text': suffix} replaces everything after the
+# first n characters of the previous partial
+INCREMENTAL_PARTIALS = os.environ.get('TRANSCRIPT_INCREMENTAL', '1') == '1'
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+RESULTS = REGISTRY.counter('transcript_results_total', 'Recognition results published').labels()
+MESSAGES = REGISTRY.counter('transcript_messages_total', 'Transcript messages sent to clients').labels()
+SEND_FAILURES = REGISTRY.counter('transcript_send_failures_total', 'Transcript messages that could not be sent').labels()
+
+
+def dumps(payload):
+    if orjson:
+        return orjson.dumps(payload).decode()
+    return _json_encoder.encode(payload)
+
+
+class TranscriptDelivery:
+    # Fans recognition results out to the sales clients of a call. Each result
+    # is serialized once in full and once per distinct suffix for incremental
+    # clients, however many recipients it has; per-client batches are joined
+    # as strings rather than re-encoded, and all sends of a flush run
+    # concurrently so one slow client doesn't hold up the rest.
+    def __init__(self, clients, window_ms=DELIVERY_WINDOW_MS, incremental=INCREMENTAL_PARTIALS):
+        self.clients = clients  # username -> {'ws', 'incremental', ...}
+        self.window = window_ms / 1000
+        self.incremental = incremental
+        # (call_id, group) -> username -> (websocket, last partial text sent on it); a
+        # suffix is only meaningful against text that recipient's socket received
+        self.last_partials = {}
+        self.pending = {}  # username -> (websocket, [(stream, is_final, payload)])
+        self.flush_timer = None
+        self.sending = set()  # In-flight flushes, referenced until they finish
+        self.results = 0
+        self.messages = 0
+        self.failures = 0
+
+    def publish(self, recipients, call_id, group, text, is_final):
+        stream = (call_id, group)
+        sent = self.last_partials.pop(stream, {}) if is_final else self.last_partials.setdefault(stream, {})
+        self.results += 1
+        RESULTS.inc()
+        full = None
+        deltas = {}  # offset -> payload; recipients that saw the same text share one
+        for username in recipients:
+            client = self.clients.get(username)
+            if not client or client['ws'].state != State.OPEN:
+                continue
+            if self.incremental and client.get('incremental') and not is_final:
+                websocket, previous = sent.get(username, (None, ''))
+                # A reconnected client has a new socket and saw none of the earlier text
+                offset = len(os.path.commonprefix((previous, text))) if websocket is client['ws'] else 0
+                sent[username] = (client['ws'], text)
+                payload = deltas.get(offset)
+                if payload is None:
+                    payload = deltas[offset] = dumps({'event': 'transcription', 'call_id': call_id, 'group': group,
+                                                      'text': text[offset:], 'offset': offset, 'is_final': False})
+            else:
+                if full is None:
+                    full = dumps({'event': 'transcription', 'call_id': call_id, 'group': group,
+                                  'text': text, 'is_final': is_final})
+                payload = full
+            self._enqueue(username, client['ws'], stream, is_final, payload, client.get('incremental'))
+        if self.pending and self.flush_timer is None:
+            if self.window:
+                self.flush_timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+            else:
+                self.flush()
+
+    def _enqueue(self, username, websocket, stream, is_final, payload, incremental):
+        pending = self.pending.get(username)
+        if pending is None or pending[0] is not websocket:
+            # Payloads are only sent on the socket they were built for
+            pending = self.pending[username] = (websocket, [])
+        batch = pending[1]
+        if is_final:
+            # The final replaces the stream's partial text, so partials still
+            # waiting for it are never worth sending
+            batch[:] = [item for item in batch if item[0] != stream or item[1]]
+        elif not (self.incremental and incremental) and batch and batch[-1][0] == stream and not batch[-1][1]:
+            # A full partial supersedes the previous one; suffixes build on
+            # each other, so those are all kept
+            batch.pop()
+        batch.append((stream, is_final, payload))
+
+    def end_stream(self, call_id, group):
+        self.last_partials.pop((call_id, group), None)
+
+    def flush(self):
+        self.flush_timer = None
+        pending, self.pending = self.pending, {}
+        sends = []
+        for username, (websocket, batch) in pending.items():
+            if websocket.state != State.OPEN:
+                continue
+            if len(batch) == 1:
+                message = batch[0][2]
+            else:
+                message = '{"event":"transcription_batch","items":[' + ','.join(item[2] for item in batch) + ']}'
+            sends.append(self._send(username, websocket, message))
+        if sends:
+            self.messages += len(sends)
+            MESSAGES.inc(len(sends))
+            flushing = asyncio.gather(*sends)
+            self.sending.add(flushing)
+            flushing.add_done_callback(self.sending.discard)
+
+    async def _send(self, username, websocket, message):
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            self.failures += 1
+            SEND_FAILURES.inc()
+            logger.debug(f"Transcript for {username} dropped, connection closed")
+        except Exception as e:
+            self.failures += 1
+            SEND_FAILURES.inc()
+            logger.error(f"Error sending transcript to {username}: {e}")
+
+    def stats(self):
+        # (results, messages, failures) since the last call
+        result = (self.results, self.messages, self.failures)
+        self.results = self.messages = self.failures = 0
+        return result
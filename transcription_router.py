@@ -0,0 +1,138 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import websockets
+from websockets import State
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+VIRTUAL_NODES = 64  # Ring points per backend, evens out consistent-hash placement
+
+SEND_FAILURES = REGISTRY.counter('transcription_router_send_failures_total',
+                                 'Failed notifications to a transcription server', ('backend',))
+BACKEND_CALLS = REGISTRY.gauge('transcription_router_calls', 'Calls placed on each transcription server', ('backend',))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class TranscriptionBackend:
+    def __init__(self, url):
+        self.url = url
+        self.socket = None
+        self.calls = set()  # Calls this signaling server placed here
+        self.reported_calls = 0
+        self.capacity = 0
+        self.draining = False
+        self.send_failures = SEND_FAILURES.labels(url)
+        BACKEND_CALLS.labels(url).fn = lambda: len(self.calls)
+
+    @property
+    def available(self):
+        return self.socket is not None and self.socket.state == State.OPEN and not self.draining
+
+    @property
+    def load(self):
+        calls = max(len(self.calls), self.reported_calls)
+        return calls / self.capacity if self.capacity else calls
+
+
+class TranscriptionRouter:
+    # Places each call on one of several transcription servers, by consistent
+    # hashing on call_id ('hash') or by the load the servers report
+    # ('least-loaded'). Placement only skips backends that are down or draining,
+    # so removing one moves nothing already running on the others.
+    def __init__(self, urls, placement='hash'):
+        if placement not in ('hash', 'least-loaded'):
+            raise ValueError(f"Unknown transcription placement: {placement}. Supported: hash, least-loaded")
+        self.backends = [TranscriptionBackend(url) for url in urls]
+        self.placement = placement
+        self.assignments = {}  # call_id -> backend
+        self.ring = sorted(((_hash(f'{backend.url}#{i}'), backend)
+                            for backend in self.backends for i in range(VIRTUAL_NODES)), key=lambda point: point[0])
+        self.ring_hashes = [point for point, _ in self.ring]
+        self.report_tasks = []
+
+    async def connect(self, ssl_context):
+        for backend in self.backends:
+            try:
+                backend.socket = await websockets.connect(backend.url, ssl=ssl_context)
+                await backend.socket.send(json.dumps({'event': 'backend_hello'}))
+                self.report_tasks.append(asyncio.create_task(self._read_reports(backend)))
+                logger.info(f"Connected to transcription server at {backend.url}")
+            except Exception as e:
+                logger.error(f"Failed to connect to transcription server {backend.url}: {e}")
+
+    async def _read_reports(self, backend):
+        try:
+            async for message in backend.socket:
+                data = json.loads(message)
+                if data.get('event') == 'load':
+                    if data['draining'] and not backend.draining:
+                        logger.warning(f"Transcription server {backend.url} is draining {data['calls']} calls")
+                    backend.reported_calls = data['calls']
+                    backend.capacity = data['capacity']
+                    backend.draining = data['draining']
+        except websockets.ConnectionClosed:
+            pass
+        logger.warning(f"Transcription server {backend.url} disconnected with {len(backend.calls)} calls")
+
+    def route(self, call_id):
+        if call_id in self.assignments:
+            return self.assignments[call_id]
+        if self.placement == 'least-loaded':
+            candidates = [backend for backend in self.backends if backend.available]
+            backend = min(candidates, key=lambda candidate: candidate.load, default=None)
+        else:
+            backend = None
+            start = bisect.bisect(self.ring_hashes, _hash(call_id))
+            for i in range(len(self.ring)):
+                candidate = self.ring[(start + i) % len(self.ring)][1]
+                if candidate.available:
+                    backend = candidate
+                    break
+        if backend:
+            backend.calls.add(call_id)
+            self.assignments[call_id] = backend
+        return backend
+
+    def release(self, call_id):
+        backend = self.assignments.pop(call_id, None)
+        if backend:
+            backend.calls.discard(call_id)
+        return backend
+
+    async def send(self, backend, event, data):
+        if backend.socket and backend.socket.state == State.OPEN:
+            try:
+                await backend.socket.send(json.dumps({'event': event, **data}))
+                logger.debug(f"Notified transcription server {backend.url}: {event} - {data}")
+                return True
+            except Exception as e:
+                logger.error(f"Error notifying transcription server {backend.url}: {e}")
+        else:
+            logger.warning(f"Transcription server {backend.url} socket not open or connected")
+        backend.send_failures.inc()
+        return False
+
+    async def notify(self, event, data):
+        # Call events go to the backend owning the call; everything else to all
+        if event == 'call_accepted':
+            backend = self.route(data['call_id'])
+            if backend is None:
+                logger.warning(f"No transcription server available for {data['call_id']}")
+            elif not await self.send(backend, event, data):
+                self.release(data['call_id'])
+                backend = None
+            return backend
+        if event == 'call_ended':
+            backend = self.release(data['call_id'])
+            if backend:
+                await self.send(backend, event, data)
+            return backend
+        await asyncio.gather(*(self.send(backend, event, data) for backend in self.backends if backend.socket))
+        return None
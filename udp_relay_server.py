@@ -1,20 +1,163 @@
+import argparse
 import asyncio
 import json
 import logging
+import multiprocessing
+import os
+import shutil
+import signal
 import ssl
+import tempfile
+import time
 import websockets
-from websockets import State
+from multiprocessing.connection import wait
+from call_index import CallIndex
+from bounded_queue import BoundedQueue, DROP_NEWEST, POLICIES
+from metrics import REGISTRY, LATENCY_BUCKETS, monitor_event_loop, serve_metrics
+from relay_link import GONE, HERE, INDEX, RemoteRoute, WorkerLink, serve_links, socket_path
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 udp_clients = {}
-calls = {}
+calls = CallIndex()
+
+# With several workers sharing port 8002 (SO_REUSEPORT) the two legs of a call
+# may be on different workers. Every worker gets every call event on its own
+# control port and announces its clients to the others, so a route can point
+# at a link to the worker holding the peer as well as at a local outbox.
+# Per-worker ports come from ranges of MAX_WORKERS that no other service's
+# defaults fall in (8001-8003 and 8013 for a second transcription backend,
+# 9102/9103 for single-process metrics).
+RELAY_WORKERS = int(os.environ.get('RELAY_WORKERS', 1))
+MAX_WORKERS = 100
+CONTROL_PORT_BASE = int(os.environ.get('RELAY_CONTROL_PORT', 8200))  # Worker i takes base + i
+WORKER_METRICS_PORT_BASE = int(os.environ.get('RELAY_WORKER_METRICS_PORT', 9200))  # Worker i takes base + i
+worker_index = 0
+worker_links = {}  # worker index -> WorkerLink
+remote_users = {}  # username -> WorkerLink to the worker holding that client
+
+# Each client has a bounded outbound queue drained by its own sender task, so a
+# slow peer never stalls the sender's receive loop. Drop-newest by default: it
+# keeps the start of the WebM stream (and its header) intact.
+QUEUE_FRAMES = int(os.environ.get('RELAY_QUEUE_FRAMES', 50))
+QUEUE_POLICY = os.environ.get('RELAY_QUEUE_POLICY', DROP_NEWEST)
+EARLY_BUFFER_FRAMES = 50  # Audio held back while the call or peer is not ready, flushed on connect
+STATS_REPORT_INTERVAL = 10  # seconds
+METRICS_PORT = int(os.environ.get('RELAY_METRICS_PORT', 9102))  # Single-process mode; 0 disables /metrics
+
+FRAMES_IN = REGISTRY.counter('relay_frames_received_total', 'Audio frames received from clients').labels()
+BYTES_IN = REGISTRY.counter('relay_bytes_received_total', 'Audio bytes received from clients').labels()
+FRAMES_OUT = REGISTRY.counter('relay_frames_sent_total', 'Audio frames relayed to peers').labels()
+BYTES_OUT = REGISTRY.counter('relay_bytes_sent_total', 'Audio bytes relayed to peers').labels()
+SEND_FAILURES = REGISTRY.counter('relay_send_failures_total', 'Relayed frames lost to a closed peer connection').labels()
+QUEUE_DROPS = REGISTRY.counter('relay_queue_dropped_total', 'Frames dropped by full outbound queues').labels()
+EARLY_DROPS = REGISTRY.counter('relay_early_dropped_total', 'Frames dropped before the call or peer was ready').labels()
+RELAY_DELAY = REGISTRY.histogram('relay_queue_delay_seconds', 'Time frames waited in the outbound queue',
+                                 LATENCY_BUCKETS).labels()
+REGISTRY.gauge('relay_clients', 'Registered relay clients', fn=lambda: len(udp_clients))
+REGISTRY.gauge('relay_active_calls', 'Calls with audio being relayed', fn=lambda: len(calls))
+REGISTRY.gauge('relay_queue_depth', 'Frames waiting in all outbound queues',
+               fn=lambda: sum(client['outbox'].qsize() for client in list(udp_clients.values())))
+REGISTRY.gauge('relay_queue_depth_max', 'Frames waiting in the fullest outbound queue',
+               fn=lambda: max((client['outbox'].qsize() for client in list(udp_clients.values())), default=0))
+
+async def forward_audio(username, client):
+    websocket, outbox = client['ws'], client['outbox']
+    while True:
+        message, queued_at = await outbox.get()
+        if message is None:  # Signal to stop
+            break
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            SEND_FAILURES.inc()
+            break
+        client['lag'] = time.monotonic() - queued_at
+        RELAY_DELAY.observe(client['lag'])
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(message))
+        outbox.task_done()
+
+async def report_stats():
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        for call_id, participants in list(calls.calls.items()):
+            clients = [udp_clients[user] for user in participants if user in udp_clients]
+            drops = sum(client['outbox'].dropped + client['early_dropped'] for client in clients)
+            reported = sum(client['reported_drops'] for client in clients)
+            if drops > reported:
+                lag = max(client['lag'] for client in clients)
+                logger.warning(f"Call {call_id} relay is {lag * 1000:.0f}ms behind; dropped {drops - reported} "
+                               f"chunks in the last {STATS_REPORT_INTERVAL}s ({QUEUE_POLICY})")
+                for client in clients:
+                    client['reported_drops'] = client['outbox'].dropped + client['early_dropped']
+
+def resolve(username):
+    # Where audio for `username` goes from this worker, if anywhere yet
+    client = udp_clients.get(username)
+    if client:
+        return client['outbox']
+    link = remote_users.get(username)
+    return RemoteRoute(link, username) if link else None
+
+def set_route(client, route):
+    # Hands over the audio held back until now, which starts with the WebM
+    # header the peer needs
+    client['route'] = route
+    if route is not None and client['early']:
+        now = time.monotonic()
+        for message in client['early']:
+            route.offer((message, now))
+        client['early'].clear()
+
+def connect_route(username, peer):
+    # Points each local side's route at the other side, wherever it is
+    for source, destination in ((username, peer), (peer, username)):
+        client = udp_clients.get(source)
+        if client:
+            set_route(client, resolve(destination))
+
+def clear_route(username, drop_early=False):
+    client = udp_clients.get(username)
+    if client:
+        client['route'] = None
+        if drop_early:
+            client['early'].clear()  # Audio from a finished call must not leak into the next one
+
+def announce(kind, username):
+    for link in worker_links.values():
+        link.send(kind, username, INDEX.pack(worker_index))
+
+def announce_all(link):
+    # A worker that (re)connects learns every client already here
+    for username in udp_clients:
+        link.send(HERE, username, INDEX.pack(worker_index))
+
+def remote_audio(username, payload):
+    client = udp_clients.get(username)
+    if client:
+        client['outbox'].offer((payload, time.monotonic()))
+
+def remote_here(username, index):
+    link = worker_links.get(index)
+    if link:
+        remote_users[username] = link
+        peer = calls.peer_of(username)
+        if peer:
+            connect_route(peer, username)  # A local connection for username still wins
+
+def remote_gone(username, index):
+    if remote_users.get(username) is worker_links.get(index):
+        del remote_users[username]
+        peer = calls.peer_of(username)
+        if peer:
+            connect_route(peer, username)  # Keeps a route to username if it is connected here
 
 async def udp_relay(websocket):
     client_ip = websocket.remote_address[0]
     username = None
-    audio_buffer = []
+    client = None
     try:
         async for message in websocket:
             if isinstance(message, str):
@@ -24,57 +167,127 @@ async def udp_relay(websocket):
                 if event == 'register':
                     group = data['group']
                     username = data['username']
-                    udp_clients[username] = {'ws': websocket}
+                    if client:
+                        client['outbox'].close((None, None))
+                    client = {
+                        'ws': websocket,
+                        'outbox': BoundedQueue(QUEUE_FRAMES, QUEUE_POLICY, QUEUE_DROPS),
+                        'route': None,  # The peer's outbox while in a connected call
+                        'early': [],  # Audio held back while the call or peer is not ready yet
+                        'lag': 0.0,
+                        'early_dropped': 0,
+                        'reported_drops': 0
+                    }
+                    client['sender'] = asyncio.create_task(forward_audio(username, client))
+                    udp_clients[username] = client
+                    announce(HERE, username)
+                    peer = calls.peer_of(username)
+                    if peer:  # Re-registered mid-call
+                        connect_route(username, peer)
                     logger.info(f"Registered client {username} from {client_ip}")
                 elif event == 'call_accepted':
                     call_id = data['call_id']
-                    calls[call_id] = {
-                        'caller': data['from_user'],
-                        'callee': data['to_user'],
-                        'caller_group': data['caller_group'],
-                        'callee_group': data['callee_group']
-                    }
+                    calls.add(call_id, data['from_user'], data['to_user'])
+                    connect_route(data['from_user'], data['to_user'])
                     logger.info(f"Call accepted: {call_id}")
                 elif event == 'call_ended':
                     call_id = data.get('call_id')
-                    if call_id in calls:
-                        del calls[call_id]
+                    participants = calls.remove(call_id)
+                    if participants:
+                        for user in participants:
+                            clear_route(user, drop_early=True)
                         logger.info(f"Ended call {call_id}")
-            elif isinstance(message, (bytes, bytearray)):
-                if username:
-                    call_id = next((cid for cid, call in calls.items() if username in (call['caller'], call['callee'])), None)
-                    if call_id:
-                        peer = calls[call_id]['callee'] if username == calls[call_id]['caller'] else calls[call_id]['caller']
-                        peer_ws = udp_clients.get(peer, {}).get('ws')
-                        if peer_ws and peer_ws.state == State.OPEN:
-                            await peer_ws.send(message)
-                            logger.debug(f"Relayed WebM Opus to {peer}: {len(message)} bytes")
-                        else:
-                            if len(audio_buffer) < 50:
-                                audio_buffer.append(message)
-                            else:
-                                logger.error(f"Buffer overflow for {username}—dropping chunk")
-                    else:
-                        if len(audio_buffer) < 50:
-                            audio_buffer.append(message)
-                        else:
-                            logger.error(f"Buffer overflow for {username}—dropping chunk")
+            elif client:
+                # Hot path: one dict lookup and a non-blocking enqueue; the
+                # destination's own sender task does the network write
+                FRAMES_IN.inc()
+                BYTES_IN.inc(len(message))
+                route = client['route']
+                if route is not None:
+                    route.offer((message, time.monotonic()))
+                elif len(client['early']) < EARLY_BUFFER_FRAMES:
+                    client['early'].append(message)
                 else:
-                    logger.warning(f"Client {client_ip} not registered—discarding audio")
+                    client['early_dropped'] += 1
+                    EARLY_DROPS.inc()
+            else:
+                logger.warning(f"Client {client_ip} not registered—discarding audio")
     except Exception as e:
         logger.error(f"UDP relay error: {e}", exc_info=True)
     finally:
-        if username and username in udp_clients:
+        if client:
+            client['outbox'].close((None, None))
+        if username and udp_clients.get(username) is client:
             del udp_clients[username]
+            announce(GONE, username)
+            peer = calls.peer_of(username)
+            if peer:
+                clear_route(peer)  # The peer's audio waits in its early buffer until we are back
             logger.warning(f"Disconnected {username} ({client_ip})")
 
-async def udp_server():
+async def udp_server(worker=0, workers=1, link_dir=None):
+    global worker_index
+    if QUEUE_POLICY not in POLICIES:
+        raise ValueError(f"Unknown RELAY_QUEUE_POLICY: {QUEUE_POLICY}. Supported: {', '.join(POLICIES)}")
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
-    server = websockets.serve(udp_relay, '0.0.0.0', 8002, ssl=ssl_context)
-    async with server:
+    worker_index = worker
+    servers = [websockets.serve(udp_relay, '0.0.0.0', 8002, ssl=ssl_context, reuse_port=workers > 1)]
+    link_tasks = []
+    if workers > 1:
+        # Call events are sent to each worker's own port; the shared one only takes clients
+        servers.append(websockets.serve(udp_relay, '0.0.0.0', CONTROL_PORT_BASE + worker, ssl=ssl_context))
+        await serve_links(socket_path(link_dir, worker), remote_audio, remote_here, remote_gone)
+        for index in range(workers):
+            if index != worker:
+                worker_links[index] = WorkerLink(index, socket_path(link_dir, index))
+                link_tasks.append(asyncio.create_task(worker_links[index].connect(announce_all)))
+    if METRICS_PORT:
+        await serve_metrics(WORKER_METRICS_PORT_BASE + worker if workers > 1 else METRICS_PORT)
+    for server in servers:
+        await server
+    stats_task = asyncio.create_task(report_stats())
+    loop_task = asyncio.create_task(monitor_event_loop())
+    if workers > 1:
+        logger.info(f"UDP relay worker {worker} started on wss://0.0.0.0:8002, "
+                    f"control on wss://0.0.0.0:{CONTROL_PORT_BASE + worker}")
+    else:
         logger.info("UDP relay WebSocket started on wss://0.0.0.0:8002")
-        await asyncio.Future()
+    await asyncio.Future()
+
+def run_worker(worker, workers, link_dir):
+    asyncio.run(udp_server(worker, workers, link_dir))
+
+def run_workers(workers):
+    # Supervisor: forks the workers and stops them all once any of them exits
+    link_dir = tempfile.mkdtemp(prefix='relay-links-')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(i, workers, link_dir), name=f'relay-worker-{i}')
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    try:
+        wait([process.sentinel for process in processes])
+        logger.warning("A relay worker exited, stopping the others")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(link_dir, ignore_errors=True)
 
 if __name__ == '__main__':
-    asyncio.run(udp_server())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="WebM audio relay")
+    parser.add_argument('--workers', type=int, default=RELAY_WORKERS,
+                        help="worker processes sharing port 8002; each also takes call events on its own control port. "
+                             "Prefer RELAY_WORKERS, which the signaling server reads to find those ports")
+    args = parser.parse_args()
+    if args.workers > MAX_WORKERS:
+        raise ValueError(f"Too many relay workers: {args.workers}. Supported: 1-{MAX_WORKERS}")
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        asyncio.run(udp_server())
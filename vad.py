@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class EnergyVAD:
+    # Energy / zero-crossing voice activity detector over fixed sub-frames of a
+    # 16-bit PCM chunk. Each chunk is classified in one vectorized pass; the only
+    # state carried between chunks is the noise floor and the trailing silence.
+    def __init__(self, sample_rate=16000, frame_ms=20, threshold_db=10.0, min_energy_db=-55.0,
+                 max_zcr=0.25, hangover_ms=300):
+        self.frame_len = sample_rate * frame_ms // 1000
+        self.frame_ms = frame_ms
+        self.threshold_db = threshold_db
+        self.min_energy_db = min_energy_db
+        self.max_zcr = max_zcr
+        self.hangover_ms = hangover_ms
+        self.noise_floor_db = min_energy_db
+        self.trailing_silence_ms = hangover_ms
+
+    def process(self, pcm):
+        samples = np.frombuffer(pcm, dtype='<i2')
+        n = len(samples) // self.frame_len
+        if n == 0:
+            return self.trailing_silence_ms < self.hangover_ms
+        frames = samples[:n * self.frame_len].reshape(n, self.frame_len).astype(np.float32) / 32768.0
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.frame_len
+
+        threshold = max(self.noise_floor_db + self.threshold_db, self.min_energy_db)
+        # Loud frames count as speech unless they look like broadband noise
+        # (high zero-crossing rate without much energy above the floor).
+        voiced = (energy_db > threshold) & ((zcr < self.max_zcr) | (energy_db > threshold + self.threshold_db))
+
+        # Noise floor follows the quietest frame: down immediately, up slowly
+        quietest = float(energy_db.min())
+        if quietest < self.noise_floor_db:
+            self.noise_floor_db = max(quietest, self.min_energy_db - 20.0)
+        else:
+            self.noise_floor_db += 0.02 * (quietest - self.noise_floor_db)
+
+        silence_before = self.trailing_silence_ms
+        voiced_idx = np.flatnonzero(voiced)
+        if voiced_idx.size:
+            self.trailing_silence_ms = (n - 1 - int(voiced_idx[-1])) * self.frame_ms
+            return True
+        self.trailing_silence_ms += n * self.frame_ms
+        # Keep decoding through the hangover so Vosk still sees word endings
+        return silence_before < self.hangover_ms
@@ -1,78 +1,181 @@
-import vosk
 import logging
-from collections import defaultdict
-import json
+import os
+import time
+from pcm_ring_buffer import PCMRingBuffer
+from vad import EnergyVAD
+from metrics import REGISTRY
+from asr_workers import RecognitionWorkerPool, WORKER_MODE, WORKER_COUNT, _open_recognizer, _accept_waveform, _finalize_recognizer, _close_recognizer
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+RECOGNIZER_CONFIG = '{"max_silence": 0.1, "min_speech_duration": 0.2, "silence_probability_threshold": 0.99}'
+STREAM_MODE = os.environ.get('ASR_STREAM_MODE', 'streaming')  # 'streaming' or 'batch'
+BATCH_CHUNK_MS = 1000
+STREAMING_CHUNK_MS = {"en": 160, "ja": 200}  # Frame size fed to Vosk per language in streaming mode
+MIN_CHUNK_MS = 20  # Bounds for a per-call chunk_ms, which comes from the browser
+MAX_CHUNK_MS = 1000
+PARTIAL_INTERVAL = 0.25  # Minimum seconds between partial results in streaming mode
+BUFFER_SECONDS = 10  # Ring capacity per stream
+VAD_ENABLED = os.environ.get('ASR_VAD', '1') != '0'
+FINALIZE_SILENCE_MS = 800  # Trailing silence after which a pending utterance is forced final
+
+DECODE_SECONDS = REGISTRY.histogram('asr_decode_seconds', 'Time Vosk spent on one chunk of audio',
+                                    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)).labels()
+SESSION_RTF = REGISTRY.histogram('asr_session_real_time_factor', 'Decode time over decoded audio time, per ended session',
+                                 (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5)).labels()
+AUDIO_SECONDS = REGISTRY.counter('asr_audio_seconds_total', 'Audio seconds by outcome', ('outcome',))
+DECODED_SECONDS = AUDIO_SECONDS.labels('decoded')
+SKIPPED_SECONDS = AUDIO_SECONDS.labels('skipped')
+
 class VoskASR:
-    def __init__(self):
-        self.models = {
-            "en": vosk.Model("vosk-model/vosk-model-en-us-0.22"),
-            "ja": vosk.Model("vosk-model/vosk-model-small-ja-0.22")
+    def __init__(self, mode=WORKER_MODE, workers=WORKER_COUNT, stream_mode=STREAM_MODE):
+        if stream_mode not in ('streaming', 'batch'):
+            raise ValueError(f"Unknown ASR stream mode: {stream_mode}. Supported: streaming, batch")
+        self.model_paths = {
+            "en": "vosk-model/vosk-model-en-us-0.22",
+            "ja": "vosk-model/vosk-model-small-ja-0.22"
         }
+        self.workers = RecognitionWorkerPool(self.model_paths, mode, workers)
         self.sessions = {}
-        self.buffers = defaultdict(bytes)
+        self.buffers = {}
         self.target_rate = 16000
-        logger.info("Vosk ASR initialized with models: en (large), ja")
+        self.workers.warm(self.target_rate, RECOGNIZER_CONFIG)
+        REGISTRY.gauge('asr_sessions', 'Active recognition streams', fn=lambda: len(self.sessions))
+        REGISTRY.gauge('asr_real_time_factor_max', 'Highest real-time factor among active streams',
+                       fn=lambda: max(map(self.real_time_factor, list(self.sessions.values())), default=0.0))
+        REGISTRY.gauge('asr_buffered_seconds', 'Audio waiting in all stream buffers',
+                       fn=lambda: sum(map(len, list(self.buffers.values()))) / (self.target_rate * 2))
+        self.stream_mode = stream_mode
+        logger.info(f"Vosk ASR initialized with models: en (large), ja, loaded on first use unless preloaded ({self.workers.size} {mode} workers, {stream_mode} mode)")
 
-    def start_session(self, call_id, language):
-        if language not in self.models:
+    # Sessions are keyed by (call_id, group) so each speaker gets their own
+    # recognizer, buffer and worker instead of one interleaved stream per call.
+    def start_session(self, call_id, group, language, chunk_ms=None):
+        if language not in self.model_paths:
             logger.error(f"Unsupported language: {language}. Supported: en, ja")
             return
-        if call_id not in self.sessions:
-            self.sessions[call_id] = {
-                'recognizer': vosk.KaldiRecognizer(self.models[language], self.target_rate, '{"max_silence": 0.1, "min_speech_duration": 0.2, "silence_probability_threshold": 0.99}'),
-                'language': language
+        if chunk_ms is not None:
+            # Clamped before the worker is pinned, so a bad value cannot leak a worker slot or recognizer
+            try:
+                chunk_ms = min(max(int(chunk_ms), MIN_CHUNK_MS), MAX_CHUNK_MS)
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring invalid chunk_ms {chunk_ms!r} for call {call_id}")
+                chunk_ms = None
+        key = (call_id, group)
+        if key not in self.sessions:
+            # The recognizer is taken from the pool on the worker the stream is pinned to; later
+            # work for the stream queues behind it on that same worker.
+            self.workers.pin(key)
+            self.workers.submit(key, _open_recognizer, key, language, self.target_rate, RECOGNIZER_CONFIG)
+            if self.stream_mode == 'batch':
+                chunk_ms, partial_interval = BATCH_CHUNK_MS, 0
+            else:
+                chunk_ms, partial_interval = chunk_ms or STREAMING_CHUNK_MS[language], PARTIAL_INTERVAL
+            chunk_bytes = self.target_rate * 2 * chunk_ms // 1000  # 16-bit mono
+            self.sessions[key] = {
+                'language': language,
+                'chunk_bytes': chunk_bytes,
+                'partial_interval': partial_interval,
+                'last_partial_at': 0.0,
+                'vad': EnergyVAD(self.target_rate) if VAD_ENABLED else None,
+                'pending_speech': False,  # Audio decoded since the last final result
+                'decoded_bytes': 0,
+                'skipped_bytes': 0,
+                'decode_seconds': 0.0
             }
-            logger.info(f"Started Vosk session for call {call_id} with language {language}")
+            # Capacity is a whole number of chunks so chunk reads never wrap
+            self.buffers[key] = PCMRingBuffer(chunk_bytes * max(1, BUFFER_SECONDS * 1000 // chunk_ms))
+            logger.info(f"Started Vosk session for call {call_id} ({group}) with language {language}, {chunk_ms} ms chunks")
 
-    async def process_audio(self, call_id, audio_chunk, username=None):
+    async def process_audio(self, call_id, group, audio_chunk, username=None):
+        key = (call_id, group)
         try:
-            if call_id not in self.sessions:
-                logger.warning(f"No session for {call_id}")
+            if key not in self.sessions:
+                logger.warning(f"No session for {call_id} ({group})")
                 return "", False
-            self.buffers[call_id] += audio_chunk
-            logger.debug(f"Buffer len for {call_id}: [{len(self.buffers[call_id])}]")
-            if len(self.buffers[call_id]) < 32000:  # ~1s at 16kHz, 16-bit
-                return "", False
-            
-            pcm_data = self.buffers[call_id][:32000]  # Slice ~1s
-            self.buffers[call_id] = self.buffers[call_id][32000:]  # Keep remainder
+            buffer = self.buffers[key]
+            if buffer.write(audio_chunk) < len(audio_chunk):
+                logger.warning(f"Buffer full for {call_id} ({group}), {buffer.dropped} bytes dropped so far")
 
             username = username or "unknown"
+            session = self.sessions[key]
+            chunk_bytes = session['chunk_bytes']
+            chunk_seconds = chunk_bytes / (self.target_rate * 2)
+            partial = ""
+            vad = session['vad']
+            while len(buffer) >= chunk_bytes:
+                pcm_data = buffer.peek(chunk_bytes)
+                if vad and not vad.process(pcm_data):
+                    # Silence (or the other party bleeding in) is skipped, not decoded
+                    buffer.consume(chunk_bytes)
+                    session['skipped_bytes'] += chunk_bytes
+                    SKIPPED_SECONDS.inc(chunk_seconds)
+                    if session['pending_speech'] and vad.trailing_silence_ms >= FINALIZE_SILENCE_MS:
+                        session['pending_speech'] = False
+                        transcript = await self.workers.run(key, _finalize_recognizer, key)
+                        if transcript:
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug(f"Final transcript after silence for {call_id} ({username}): '{transcript}'")
+                            return transcript, True
+                    continue
+                session['decoded_bytes'] += chunk_bytes
+                DECODED_SECONDS.inc(chunk_seconds)
+                session['pending_speech'] = True
+                if self.workers.mode == 'process':
+                    pcm_data = bytes(pcm_data)  # Views cannot cross the process boundary
 
-            # Vosk transcription
-            recognizer = self.sessions[call_id]['recognizer']
-            if recognizer.AcceptWaveform(pcm_data):
-                result = json.loads(recognizer.Result())
-                transcript = result.get("text", "")
-                logger.info(f"Final transcript for {call_id} ({username}): '{transcript}'")
-                return transcript, True
-            else:
-                partial = json.loads(recognizer.PartialResult())
-                transcript = partial.get("partial", "")
-                logger.info(f"Partial transcript for {call_id} ({username}): '{transcript}'")
-                return transcript, False
+                # Partials are throttled by time rather than by buffer size; skipping
+                # PartialResult() on the in-between frames keeps CPU per call flat.
+                now = time.monotonic()
+                want_partial = now - session['last_partial_at'] >= session['partial_interval']
+                if want_partial:
+                    session['last_partial_at'] = now
+
+                # Vosk transcription, off the event loop on the stream's worker
+                transcript, is_final, decode_seconds = await self.workers.run(key, _accept_waveform, key, pcm_data, want_partial)
+                buffer.consume(chunk_bytes)
+                session['decode_seconds'] += decode_seconds
+                DECODE_SECONDS.observe(decode_seconds)
+                if is_final:
+                    session['pending_speech'] = False
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Final transcript for {call_id} ({username}): '{transcript}'")
+                    return transcript, True
+                if transcript:
+                    partial = transcript
+            return partial, False
         except Exception as e:
-            logger.error(f"Error processing audio for {call_id}: {e}", exc_info=True)
+            logger.error(f"Error processing audio for {call_id} ({group}): {e}", exc_info=True)
             return "", False
 
-    def end_session(self, call_id):
-        if call_id in self.sessions:
-            recognizer = self.sessions[call_id]['recognizer']
-            if self.buffers[call_id]:
-                pcm_data = self.buffers[call_id]
-                username = "unknown"
-                if recognizer.AcceptWaveform(pcm_data):
-                    result = json.loads(recognizer.Result())
-                else:
-                    result = json.loads(recognizer.FinalResult())  # Force final result
-                transcript = result.get("text", "")
-                if transcript:
-                    logger.info(f"Final transcript at end for {call_id} ({username}): '{transcript}'")
-            del self.sessions[call_id]
-            self.buffers.pop(call_id, None)
+    def backlog(self, call_id, group):
+        buffer = self.buffers.get((call_id, group))
+        if buffer is None:
+            return None
+        return {'bytes': len(buffer), 'fill': buffer.fill_ratio, 'dropped': buffer.dropped}
+
+    def real_time_factor(self, session):
+        decoded_seconds = session['decoded_bytes'] / (self.target_rate * 2)
+        return session['decode_seconds'] / decoded_seconds if decoded_seconds else 0.0
+
+    async def end_session(self, call_id, group):
+        key = (call_id, group)
+        if key in self.sessions:
+            session = self.sessions.pop(key)
+            buffer = self.buffers.pop(key, None)
+            pcm_data = buffer.drain() if buffer else b""
+            try:
+                transcript = await self.workers.run(key, _close_recognizer, key, pcm_data)
+            finally:
+                self.workers.release(key)
+            if transcript:
+                logger.info(f"Final transcript at end for {call_id} ({group}): '{transcript}'")
+            bytes_per_second = self.target_rate * 2
+            rtf = self.real_time_factor(session)
+            if session['decoded_bytes']:
+                SESSION_RTF.observe(rtf)
+            logger.info(f"Session {call_id} ({group}) decoded {session['decoded_bytes'] / bytes_per_second:.1f}s "
+                        f"at RTF {rtf:.2f}, skipped {session['skipped_bytes'] / bytes_per_second:.1f}s of silence")
             return transcript, True if transcript else False
-        return "", False
\ No newline at end of file
+        return "", False